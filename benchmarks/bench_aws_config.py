@@ -0,0 +1,61 @@
+#! /usr/bin/env python3
+"""Compare configparser with the single pass aws config parser.
+
+    python benchmarks/bench_aws_config.py [profiles]
+"""
+
+import os
+import sys
+import time
+import tempfile
+import configparser
+
+import pterm
+from pterm import awsconfig
+from synthetic import aws_config
+
+
+def with_configparser(path):
+    """Parse the config and read the profile keys the way pterm did."""
+    config = configparser.ConfigParser()
+    config.read(path)
+    for section in config.sections():
+        config[section].get('azure_tenant_id', None)
+        config[section].get('source_profile', None)
+        config[section].get('role_arn', None)
+
+
+def with_awsconfig(path):
+    """Parse the config with the single pass parser."""
+    awsconfig.clear_cache()
+    pterm.aws_config_to_profiles(path)
+
+
+def cached(path):
+    """Read the profiles from the already parsed config."""
+    pterm.aws_config_to_profiles(path)
+
+
+def main():
+    """Run the benchmark."""
+    profiles = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'config')
+        with open(path, 'w') as out:
+            out.write(aws_config(profiles))
+        print(f'aws config with {profiles} profiles, {os.path.getsize(path) / 1024:.0f}KiB')
+
+        for name, func in (('configparser', with_configparser),
+                           ('awsconfig', with_awsconfig),
+                           ('cached', cached)):
+            best = None
+            for _ in range(3):
+                start = time.perf_counter()
+                func(path)
+                elapsed = time.perf_counter() - start
+                best = elapsed if best is None else min(best, elapsed)
+            print(f'{name:12} {best * 1000:10.1f}ms')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,44 @@
+#! /usr/bin/env python3
+"""Compare the size and parse time of full and inherited profile files.
+
+    python benchmarks/bench_inherit.py [profiles]
+"""
+
+import sys
+import json
+import time
+
+import pterm
+
+
+def parse_time(data, rounds=5):
+    """Return the best time to parse `data`."""
+    best = None
+    for _ in range(rounds):
+        start = time.perf_counter()
+        json.loads(data)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    """Run the benchmark."""
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 3000
+    profiles = [
+        pterm.mkprofile(f'profile-{x}', source_profile='source', tags=['123', 'role'])
+        for x in range(count)
+    ]
+
+    outputs = (
+        ('full', profiles),
+        ('inherit', pterm.inherit_profiles(profiles)),
+    )
+    for name, output in outputs:
+        data = json.dumps({'Profiles': output}, indent=4)
+        print(f'{name:8} {count} profiles {len(data) / 1024 / 1024:8.2f}MiB '
+              f'parse {parse_time(data) * 1000:8.1f}ms')
+
+
+if __name__ == '__main__':
+    main()
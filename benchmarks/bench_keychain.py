@@ -0,0 +1,42 @@
+#! /usr/bin/env python3
+"""Compare one keychain lookup per key with a single batched read.
+
+The in memory keychain sleeps `latency` seconds per call to stand in for
+spawning `security`.
+
+    python benchmarks/bench_keychain.py [keys] [latency]
+"""
+
+import sys
+import time
+
+from pterm.keychain import CachedKeychain
+from pterm.keychain import MemoryKeychain
+
+
+def main():
+    """Run the benchmark."""
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    latency = float(sys.argv[2]) if len(sys.argv) > 2 else 0.01
+    names = [f'arn:aws:iam::{x}:user/bench' for x in range(count)]
+    items = {x: f'AWS_ACCESS_KEY_ID={x} AWS_SECRET_KEY_ID=secret' for x in names}
+
+    memory = MemoryKeychain(items, latency)
+    start = time.perf_counter()
+    for name in names:
+        memory.find(name)
+    elapsed = time.perf_counter() - start
+    print(f'per-key {count} keys {memory.calls:5} calls {elapsed * 1000:10.1f}ms')
+
+    memory = MemoryKeychain(items, latency)
+    keychain = CachedKeychain(memory)
+    start = time.perf_counter()
+    keychain.prefetch(names)
+    for name in names:
+        keychain.find(name)
+    elapsed = time.perf_counter() - start
+    print(f'batched {count} keys {memory.calls:5} calls {elapsed * 1000:10.1f}ms')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,54 @@
+#! /usr/bin/env python3
+"""Compare the Profile model with building the profiles as dicts.
+
+    python benchmarks/bench_profile_model.py [profiles]
+"""
+
+import io
+import sys
+import time
+import tracemalloc
+
+import pterm
+
+
+def as_dicts(count):
+    """Create the aws profiles as dicts."""
+    return [
+        pterm.mkprofile(f'profile-{x}', tags=['123', 'role'])
+        for x in range(count)
+    ]
+
+
+def as_profiles(count):
+    """Create the aws profiles as Profile objects."""
+    return [
+        pterm.new_aws_profile(f'profile-{x}', tags=['123', 'role'])
+        for x in range(count)
+    ]
+
+
+def measure(func, count):
+    """Return the seconds to create and write `count` profiles and the peak
+    bytes held by the created profiles."""
+    pterm.profile_template()
+    tracemalloc.start()
+    start = time.perf_counter()
+    profiles = func(count)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    pterm.dump_profiles(profiles, io.StringIO())
+    elapsed = time.perf_counter() - start
+    return elapsed, peak
+
+
+def main():
+    """Run the benchmark."""
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    for name, func in (('dict', as_dicts), ('profile', as_profiles)):
+        elapsed, peak = measure(func, count)
+        print(f'{name:8} {count} profiles {elapsed * 1000:8.1f}ms {peak / 1024 / 1024:8.2f}MiB')
+
+
+if __name__ == '__main__':
+    main()
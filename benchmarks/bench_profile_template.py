@@ -0,0 +1,52 @@
+#! /usr/bin/env python3
+"""Compare shared profile templates with building the rules per profile.
+
+    python benchmarks/bench_profile_template.py [profiles]
+"""
+
+import sys
+import time
+import tracemalloc
+
+import pterm
+from pterm.rules import clear_cache
+
+
+def per_profile(name):
+    """Create a profile the way pterm did before the shared template."""
+    profile = pterm.create_profile(name)
+    clear_cache()
+    profile["Smart Selection Rules"] = pterm.smart_selection_rules()
+    profile["Triggers"] = pterm.triggers()
+    profile["Keyboard Map"] = pterm.keybinds()
+    return profile
+
+
+def shared(name):
+    """Create a profile using the shared template."""
+    return pterm.create_profile(name)
+
+
+def measure(func, count):
+    """Return the seconds and peak bytes to create `count` profiles."""
+    pterm.reset_profile_template()
+    tracemalloc.start()
+    start = time.perf_counter()
+    profiles = [func(f'profile-{x}') for x in range(count)]
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del profiles
+    return elapsed, peak
+
+
+def main():
+    """Run the benchmark."""
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 3000
+    for name, func in (('per-profile', per_profile), ('shared', shared)):
+        elapsed, peak = measure(func, count)
+        print(f'{name:12} {count} profiles {elapsed * 1000:8.1f}ms {peak / 1024 / 1024:8.2f}MiB')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,56 @@
+#! /usr/bin/env python3
+"""Compare k8s profile creation with a linear and an indexed source lookup.
+
+    python benchmarks/bench_source_index.py [profiles] [clusters]
+"""
+
+import io
+import sys
+import time
+import contextlib
+
+import pterm
+
+
+def cluster(name, aws_profile):
+    """Return a carved kubeconfig using `aws_profile`."""
+    return {
+        'current-context': name,
+        'users': [{
+            'name': name,
+            'user': {'exec': {'env': [
+                {'name': 'AWS_PROFILE', 'value': aws_profile},
+            ]}},
+        }],
+    }
+
+
+def main():
+    """Run the benchmark."""
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    clusters = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+
+    aws_profiles = [
+        {'Name': f'profile-{x}', 'Tags': [f'source_profile_source-{x % 10}']}
+        for x in range(count)
+    ]
+    configs = [
+        cluster(f'cluster-{x}', f'profile-{x * 7 % count}')
+        for x in range(clusters)
+    ]
+
+    for name, lookup in (
+            ('linear', lambda: aws_profiles),
+            ('index', lambda: pterm.source_profile_index(aws_profiles)),
+    ):
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            profiles = lookup()
+            for this in configs:
+                pterm.create_k8s_profile(this, '/dev/null', profiles)
+        elapsed = time.perf_counter() - start
+        print(f'{name:7} {count} profiles {clusters} clusters {elapsed * 1000:10.1f}ms')
+
+
+if __name__ == '__main__':
+    main()
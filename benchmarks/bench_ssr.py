@@ -0,0 +1,58 @@
+#! /usr/bin/env python3
+"""Time every smart selection rule over a corpus of terminal output.
+
+Rules taking more than `factor` times the median are flagged as slow.
+
+    python benchmarks/bench_ssr.py [lines] [factor]
+"""
+
+import sys
+import time
+import statistics
+
+import pterm
+
+SAMPLES = [
+    'drwxr-xr-x  12 user  staff   384 Oct 18 10:12 terraform',
+    'resource "aws_iam_role" "this" {',
+    'data "aws_caller_identity" "current" {}',
+    'arn:aws:iam::123456789012:role/deploy-role_name',
+    'arn:aws:iam::123456789012:policy/read-only',
+    'arn:aws:lambda:eu-west-1:123456789012:function:handler-name',
+    'arn:aws:acm-pca:eu-west-1:123456789012:certificate-authority/1234-abcd',
+    '2020-03-04T10:11:12.123Z INFO  request_id=abc-123 status=200 took=12ms',
+    'Error: Error creating IAM Role deploy: EntityAlreadyExists: Role exists',
+    'a' * 200 + '!',
+    'aws_' + '_' * 200 + '"',
+]
+
+
+def corpus(lines):
+    """Return `lines` lines of sample terminal output."""
+    return [SAMPLES[x % len(SAMPLES)] for x in range(lines)]
+
+
+def main():
+    """Run the benchmark."""
+    lines = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    factor = float(sys.argv[2]) if len(sys.argv) > 2 else 10
+    text = corpus(lines)
+
+    timings = []
+    for rule, pattern in pterm.compiled_smart_selection_rules():
+        if pattern is None:
+            continue
+        start = time.perf_counter()
+        for line in text:
+            for _ in pattern.finditer(line):
+                pass
+        timings += [(pterm.rules.rule_name(rule), time.perf_counter() - start)]
+
+    median = statistics.median(x for _, x in timings)
+    for name, elapsed in timings:
+        slow = ' SLOW' if elapsed > median * factor else ''
+        print(f'{elapsed * 1000:10.1f}ms {name}{slow}')
+
+
+if __name__ == '__main__':
+    main()
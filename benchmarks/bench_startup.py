@@ -0,0 +1,53 @@
+#! /usr/bin/env python3
+"""Measure the startup time of pterm with `python -X importtime`.
+
+    python benchmarks/bench_startup.py [top]
+"""
+
+import os
+import sys
+import time
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HEAVY = ('boto3', 'botocore', 'sh', 'yaml', 'iterm2')
+
+
+def importtime(code):
+    """Return the cumulative import time in us of every top level module."""
+    env = dict(os.environ, PYTHONPATH=ROOT)
+    stderr = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', code],
+        env=env, stderr=subprocess.PIPE, check=True,
+    ).stderr.decode()
+
+    ret = {}
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = [x.strip() for x in line[len('import time:'):].split('|')]
+        ret[name] = int(cumulative)
+    return ret
+
+
+def main():
+    """Run the benchmark."""
+    top = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    modules = importtime('import pterm')
+    print(f"import pterm {modules['pterm'] / 1000:8.1f}ms")
+    heavy = [x for x in HEAVY if x in modules]
+    print(f"heavy modules imported: {', '.join(heavy) or 'none'}")
+    for name, cumulative in sorted(modules.items(), key=lambda x: -x[1])[:top]:
+        print(f'    {cumulative / 1000:8.1f}ms {name}')
+
+    start = time.perf_counter()
+    subprocess.run(
+        [sys.executable, os.path.join(ROOT, 'scripts', 'pterm'), '--version'],
+        env=dict(os.environ, PYTHONPATH=ROOT), stdout=subprocess.DEVNULL,
+        check=True,
+    )
+    print(f'pterm --version {(time.perf_counter() - start) * 1000:8.1f}ms')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,45 @@
+#! /usr/bin/env python3
+"""Compare the libyaml and pure python backends on a large kubeconfig.
+
+    python benchmarks/bench_yaml.py [clusters]
+"""
+
+import sys
+import time
+
+import yaml
+
+import pterm
+from synthetic import kubeconfig
+
+
+def backends():
+    """Return the available yaml backends."""
+    ret = [('python', yaml.SafeLoader, yaml.SafeDumper)]
+    if hasattr(yaml, 'CSafeLoader'):
+        ret += [('libyaml', yaml.CSafeLoader, yaml.CSafeDumper)]
+    else:
+        print('libyaml is not available, only the python backend is measured')
+    return ret
+
+
+def main():
+    """Run the benchmark."""
+    clusters = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    data = yaml.dump(kubeconfig(clusters), Dumper=yaml.SafeDumper)
+    print(f'kubeconfig with {clusters} clusters, {len(data) / 1024 / 1024:.1f}MiB')
+
+    for name, loader, dumper in backends():
+        start = time.perf_counter()
+        config = pterm.load_yaml(data, loader)
+        loaded = time.perf_counter() - start
+
+        start = time.perf_counter()
+        for _, this in pterm.split_k8s_config(config):
+            pterm.dump_yaml(this, dumper=dumper)
+        dumped = time.perf_counter() - start
+        print(f'{name:8} load {loaded * 1000:10.1f}ms dump {dumped * 1000:10.1f}ms')
+
+
+if __name__ == '__main__':
+    main()
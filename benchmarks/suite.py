@@ -0,0 +1,184 @@
+#! /usr/bin/env python3
+"""Benchmark suite of the pterm stages over synthetic configs.
+
+Every stage is timed and its peak memory is measured with tracemalloc, and
+the results are compared with benchmarks/baseline.json. A stage slower or
+bigger than the baseline by more than the tolerance is a regression and
+makes the suite exit with 1.
+
+    python benchmarks/suite.py [--full] [--update] [--stage NAME]
+"""
+
+import io
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import contextlib
+import tracemalloc
+
+import synthetic
+
+import pterm
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+SIZES = {
+    'quick': {'aws': [1000, 5000], 'kube': [100, 1000]},
+    'full': {'aws': [1000, 10000, 50000], 'kube': [100, 1000, 10000]},
+}
+
+
+def measure(func, repeat=1):
+    """Return the best time and the peak traced memory of `func`."""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    tracemalloc.start()
+    try:
+        func()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return best, peak
+
+
+def aws_stages(size, directory):
+    """Yield the stages working on an aws config of `size` profiles."""
+    path = os.path.join(directory, f'aws-{size}')
+    with open(path, 'w') as out:
+        out.write(synthetic.aws_config(size))
+
+    def aws_config_to_profiles():
+        pterm.awsconfig.clear_cache()
+        pterm.aws_config_to_profiles(path)
+    yield 'aws_config_to_profiles', aws_config_to_profiles
+
+    def create_aws_profiles():
+        pterm.awsconfig.clear_cache()
+        pterm.create_aws_profiles(path, lambda: '/bin')
+    yield 'create_aws_profiles', create_aws_profiles
+
+    def iter_aws_profiles():
+        pterm.awsconfig.clear_cache()
+        list(pterm.iter_aws_profiles(path, lambda: '/bin'))
+    yield 'iter_aws_profiles', iter_aws_profiles
+
+    profiles = pterm.create_aws_profiles(path, lambda: '/bin')
+    dest = os.path.join(directory, f'profiles-{size}.json')
+    yield 'write_profiles', lambda: pterm.write_profiles(dest, profiles)
+    yield 'write_profiles_compact', lambda: pterm.write_profiles(dest, profiles, True)
+
+
+def kube_stages(size, directory):
+    """Yield the stages working on a kubeconfig of `size` clusters."""
+    path = os.path.join(directory, f'aws-kube-{size}')
+    with open(path, 'w') as out:
+        out.write(synthetic.aws_config(size))
+    aws_profiles = pterm.create_aws_profiles(path, lambda: '/bin')
+    config = synthetic.kubeconfig(size)
+    clusters = [this for _, this in pterm.split_k8s_config(config)]
+    names = [pterm.k8s_aws_profile(x) for x in clusters]
+
+    yield 'split_k8s_config', lambda: list(pterm.split_k8s_config(config))
+
+    def find_source_profiles():
+        index = pterm.source_profile_index(aws_profiles)
+        for name in names:
+            pterm.find_source_profile(name, index)
+    yield 'find_source_profile', find_source_profiles
+
+    def create_k8s_profiles():
+        index = pterm.source_profile_index(aws_profiles)
+        for this in clusters:
+            pterm.create_k8s_profile(this, '/dev/null', index)
+    yield 'create_k8s_profiles', create_k8s_profiles
+
+    yield 'dump_yaml', lambda: [pterm.dump_yaml(x) for x in clusters[:100]]
+
+
+def run(sizes, selected, repeat=3):
+    """Run the stages and return their results by name."""
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        for kind, stages in (('aws', aws_stages), ('kube', kube_stages)):
+            for size in sizes[kind]:
+                for name, func in stages(size, directory):
+                    key = f'{name}[{size}]'
+                    if selected and name not in selected:
+                        continue
+                    with contextlib.redirect_stdout(io.StringIO()):
+                        elapsed, peak = measure(func, repeat)
+                    results[key] = {'time': elapsed, 'peak': peak}
+                    print(f'{key:36} {elapsed * 1000:10.1f}ms {peak / 1024 / 1024:9.2f}MiB',
+                          flush=True)
+    return results
+
+
+def compare(results, baseline, time_tolerance, memory_tolerance):
+    """Print the changes from the baseline and return the regressions."""
+    regressions = []
+    for key, result in results.items():
+        base = baseline.get(key)
+        if base is None:
+            continue
+        time_ratio = result['time'] / base['time'] if base['time'] else 1
+        peak_ratio = result['peak'] / base['peak'] if base['peak'] else 1
+        slower = time_ratio > time_tolerance and result['time'] - base['time'] > 0.005
+        bigger = peak_ratio > memory_tolerance
+        flag = ' REGRESSION' if slower or bigger else ''
+        print(f'{key:36} time x{time_ratio:5.2f} peak x{peak_ratio:5.2f}{flag}')
+        if flag:
+            regressions += [key]
+    return regressions
+
+
+def main():
+    """Run the benchmark suite."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--full', action='store_true',
+                        help='Use the large config sizes')
+    parser.add_argument('--update', action='store_true',
+                        help='Write the results as the new baseline')
+    parser.add_argument('--stage', action='append', default=[],
+                        help='Only run the given stages')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='Keep the best time of this many runs')
+    parser.add_argument('--baseline', default=BASELINE,
+                        help='Baseline file')
+    parser.add_argument('--time-tolerance', type=float, default=1.5,
+                        help='Slowdown ratio reported as a regression')
+    parser.add_argument('--memory-tolerance', type=float, default=1.2,
+                        help='Peak memory ratio reported as a regression')
+    args = parser.parse_args()
+
+    results = run(
+        SIZES['full' if args.full else 'quick'], args.stage, args.repeat
+    )
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as out:
+            baseline = json.load(out)
+
+    if args.update:
+        baseline.update(results)
+        with open(args.baseline, 'w') as out:
+            json.dump(baseline, out, indent=4, sort_keys=True)
+            out.write('\n')
+        return 0
+
+    print()
+    regressions = compare(
+        results, baseline, args.time_tolerance, args.memory_tolerance
+    )
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,85 @@
+"""Generators of synthetic aws configs and kubeconfigs for the benchmarks."""
+
+import base64
+
+
+def aws_config(profiles, sources=10, azure=2):
+    """Return an aws config with `profiles` role profiles.
+
+    The roles use `sources` source profiles, the first `azure` of which are
+    aws-azure-login profiles.
+    """
+    lines = []
+    for index in range(sources):
+        lines += [f'[profile source-{index}]']
+        if index < azure:
+            lines += [
+                'azure_tenant_id = 00000000-0000-0000-0000-000000000000',
+                'azure_app_id_uri = https://signin.aws.amazon.com/saml',
+            ]
+        lines += ['region = eu-west-1', '']
+
+    for index in range(profiles):
+        name = f'role-{index}'
+        if index % 7 == 0:
+            name += '-prod'
+        lines += [
+            f'[profile {name}]',
+            f'role_arn = arn:aws:iam::{100000000000 + index}:role/admin',
+            f'source_profile = source-{index % sources}',
+            'region = eu-west-1',
+            '',
+        ]
+    return '\n'.join(lines)
+
+
+def aws_profile_names(profiles):
+    """Return the names of the role profiles of aws_config."""
+    return [
+        f'role-{x}-prod' if x % 7 == 0 else f'role-{x}'
+        for x in range(profiles)
+    ]
+
+
+def kubeconfig(clusters, profiles=None, ca_size=1536):
+    """Return a kubeconfig with `clusters` clusters and embedded CA data.
+
+    Every cluster uses one of the role profiles of aws_config(`profiles`).
+    """
+    names = aws_profile_names(profiles or clusters)
+    ca_data = base64.b64encode(bytes(range(256)) * (ca_size // 256)).decode()
+    config = {
+        'apiVersion': 'v1',
+        'kind': 'Config',
+        'preferences': {},
+        'clusters': [],
+        'contexts': [],
+        'users': [],
+        'current-context': 'cluster-0',
+    }
+    for index in range(clusters):
+        name = f'cluster-{index}'
+        config['clusters'] += [{
+            'name': name,
+            'cluster': {
+                'certificate-authority-data': ca_data,
+                'server': f'https://{name}.example.com',
+            },
+        }]
+        config['contexts'] += [{
+            'name': name,
+            'context': {'cluster': name, 'user': f'{name}-user'},
+        }]
+        config['users'] += [{
+            'name': f'{name}-user',
+            'user': {'exec': {
+                'apiVersion': 'client.authentication.k8s.io/v1alpha1',
+                'command': 'aws-iam-authenticator',
+                'args': ['token', '-i', name],
+                'env': [{
+                    'name': 'AWS_PROFILE',
+                    'value': names[index % len(names)],
+                }],
+            }},
+        }]
+    return config
@@ -2,59 +2,260 @@
 
 """Generate iterm2 profiles for your aws and k8s clusters."""
 
+import io
 import sys
-import configparser
 import os
 import re
 import json
 from copy import deepcopy
 import shutil
-import collections
+import contextlib
 import difflib
 import tempfile
-import boto3
-import sh
+import threading
+from pterm import awsconfig
+from pterm.manifest import cached_profile
+from pterm.rules import load_rules
+from pterm.instrument import instrumented
+from pterm.instrument import timed
+from pterm.identities import cached_identity
+from pterm.keychain import CachedKeychain
+from pterm.keychain import SecurityKeychain
+from pterm.keystore import KeyStore
+from pterm.profile import Profile
+from pterm.profile import as_dict
 
-HAS_SECURITY = True
-try:
-    from sh import security  # pylint: disable=no-name-in-module
-except ImportError:
-    HAS_SECURITY = False
+# boto3, sh and yaml are slow to import, so they are only imported by the
+# functions that use them, and PATH is only searched when a binary is needed.
 
-HAS_VAULT = True
-try:
-    from sh import vault
-except ImportError:
-    HAS_VAULT = False
 
+def has_security():
+    """Return True if the macOS `security` binary is available."""
+    return shutil.which('security') is not None
 
-def sort_aws_config(path, dry=False):
-    """Sort the aws config alphabetically."""
-    config = configparser.ConfigParser({}, collections.OrderedDict)
-    config.read(path)
 
-    for section in config._sections:
-        config._sections[section] = collections.OrderedDict(
-            sorted(config._sections[section].items(), key=lambda t: t[0])
-        )
+def has_vault():
+    """Return True if the vault binary is available."""
+    return shutil.which('vault') is not None
 
-    # Order all sections alphabetically
-    config._sections = collections.OrderedDict(
-        sorted(config._sections.items(), key=lambda t: t[0])
-    )
+
+@instrumented('sort aws config')
+def sort_aws_config(path, dry=False):
+    """Sort the aws config alphabetically."""
+    config = awsconfig.sort(awsconfig.load(path))
+    data = awsconfig.dumps(config)
 
     if dry:
-        new_config = tempfile.NamedTemporaryFile()
-        with open(new_config.name, 'w') as out:
-            config.write(out)
         diff = difflib.unified_diff(
             [x.strip() for x in tuple(open(path, 'r'))],
-            [x.strip() for x in tuple(open(new_config.name, 'r'))]
+            [x.strip() for x in data.splitlines()]
         )
         print('\n'.join(diff))
         return
+    try:
+        with open(path, 'r') as out:
+            if out.read() == data:
+                return
+    except FileNotFoundError:
+        pass
     with open(path, 'w') as out:
-        config.write(out)
+        out.write(data)
+    awsconfig.store(path, config)
+
+
+@contextlib.contextmanager
+def atomic_open(path, mode='w'):
+    """Open a temporary file next to `path` and rename it over on success.
+
+    Readers never see a partially written file. The mode of an existing
+    file is kept.
+    """
+    fd, tmp = tempfile.mkstemp(
+        dir=os.path.dirname(path) or '.',
+        prefix=f'.{os.path.basename(path)}.',
+        suffix='.tmp',
+    )
+    try:
+        with os.fdopen(fd, mode) as out:
+            yield out
+        if os.path.exists(path):
+            shutil.copymode(path, tmp)
+        os.replace(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+        raise
+
+
+@instrumented('file write')
+def atomic_write(path, data):
+    """Atomically write the bytes `data` to `path`."""
+    with atomic_open(path, 'wb') as out:
+        out.write(data)
+
+
+def write_if_changed(path, data):
+    """Atomically write `data` to `path` unless the file already contains it.
+
+    Returns True if the file was written.
+    """
+    if isinstance(data, str):
+        data = data.encode()
+    try:
+        if os.path.getsize(path) == len(data):
+            with open(path, 'rb') as out:
+                if out.read() == data:
+                    return False
+    except OSError:
+        pass
+    atomic_write(path, data)
+    return True
+
+
+def prune_k8s_configs(written, keep):
+    """Delete the split kubeconfig files of `written` that are not in `keep`.
+
+    `written` are the files pterm wrote before, so kubeconfigs made by hand
+    are never deleted. Returns the deleted files.
+    """
+    keep = {os.path.abspath(x) for x in keep}
+    removed = []
+    for path in sorted({os.path.abspath(x) for x in written}):
+        name = os.path.basename(path)
+        if not (name.startswith('config.') and name.endswith('.yml')):
+            continue
+        if path in keep or not os.path.isfile(path):
+            continue
+        os.unlink(path)
+        removed += [path]
+    return removed
+
+
+def dump_profiles(profiles, out, compact=False):
+    """Write the dynamic profiles document to `out` one profile at a time.
+
+    The indented output is the same as json.dumps with an indent of 4, but
+    only one profile is serialised in memory at any time.
+    """
+    if compact:
+        out.write('{"Profiles":[')
+        for index, profile in enumerate(profiles):
+            if index:
+                out.write(',')
+            out.write(json.dumps(as_dict(profile), separators=(',', ':')))
+        out.write(']}')
+        return
+
+    out.write('{\n    "Profiles": [')
+    empty = True
+    for profile in profiles:
+        out.write('\n        ' if empty else ',\n        ')
+        out.write(json.dumps(as_dict(profile), indent=4).replace('\n', '\n        '))
+        empty = False
+    out.write(']\n}' if empty else '\n    ]\n}')
+
+
+@instrumented('write profiles')
+def write_profiles(path, profiles, compact=False):
+    """Stream the profiles to a temporary file and rename it to `path`."""
+    with atomic_open(path) as out:
+        dump_profiles(profiles, out, compact)
+
+
+SHARDS = ('base', 'keys', 'aws', 'login', 'k8s', 'default')
+
+# iTerm2 loads the profile files in alphabetical order and a parent profile
+# has to be loaded before the profiles inheriting from it, so the file of the
+# base shard sorts before the others.
+SHARD_FILES = {'base': '0-base'}
+
+
+def shard_path(dest, shard):
+    """Return the file of a shard of the profiles written to `dest`."""
+    stem, ext = os.path.splitext(dest)
+    return f'{stem}.{SHARD_FILES.get(shard, shard)}{ext}'
+
+
+def shard_paths(dest):
+    """Return the files of all the shards of `dest`."""
+    return [shard_path(dest, x) for x in SHARDS]
+
+
+def remove_files(paths):
+    """Delete the files in `paths` that exist, returning the deleted ones."""
+    removed = []
+    for path in paths:
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            continue
+        removed += [path]
+    return removed
+
+
+@instrumented('write shards')
+def write_shards(dest, shards, compact=False):
+    """Write every shard of profiles to its own file next to `dest`.
+
+    `shards` maps names from SHARDS to their profiles, so adding a cluster
+    only rewrites the k8s shard and iTerm2 only reloads that file. Shards
+    whose content didnt change aren't written. The files of the empty shards
+    and the single `dest` file are deleted once the new shards are in place,
+    so iTerm2 never misses a profile. Returns the paths of the shards.
+    """
+    unknown = set(shards) - set(SHARDS)
+    if unknown:
+        raise ValueError(f"unknown shards {', '.join(sorted(unknown))}")
+
+    written = []
+    for shard in SHARDS:
+        if not shards.get(shard):
+            continue
+        path = shard_path(dest, shard)
+        out = io.StringIO()
+        dump_profiles(shards[shard], out, compact)
+        write_if_changed(path, out.getvalue())
+        written += [path]
+
+    remove_files(x for x in [dest] + shard_paths(dest) if x not in written)
+    return written
+
+
+def diff_profiles(old, new):
+    """Compare two lists of profiles by Guid.
+
+    Returns a dict with the added and removed Guids and, for every changed
+    profile, the keys that differ.
+    """
+    old = {x.get('Guid'): x for x in old}
+    new = {x.get('Guid'): x for x in new}
+
+    changed = {}
+    for guid, profile in new.items():
+        previous = old.get(guid)
+        if previous is None or previous == profile:
+            continue
+        changed[guid] = sorted(
+            key for key in set(previous) | set(profile)
+            if previous.get(key) != profile.get(key)
+        )
+
+    return {
+        'added': [x for x in new if x not in old],
+        'removed': [x for x in old if x not in new],
+        'changed': changed,
+    }
+
+
+def format_diff(diff):
+    """Return the lines describing a profile diff."""
+    ret = [f'+ {x}' for x in diff['added']]
+    ret += [f'- {x}' for x in diff['removed']]
+    ret += [
+        f"~ {guid}: {', '.join(keys)}"
+        for guid, keys in diff['changed'].items()
+    ]
+    return ret
 
 
 def dissasemble_iam_arn(arn):
@@ -63,24 +264,26 @@ def dissasemble_iam_arn(arn):
     return account, role
 
 
+@instrumented('aws config')
 def aws_config_to_profiles(aws_config):
     """Convert aws config to iterm2 profiles."""
-    config = configparser.ConfigParser()
-    config.read(aws_config)
     ret = {}
-    for section in config.sections():
+    for section, keys in awsconfig.load(aws_config).items():
+        name = awsconfig.profile_name(section)
+        if name is None:
+            continue
         new = {
-            'name': section.split()[1],
+            'name': name,
             'account': None,
             'role': None,
-            'azure': config[section].get('azure_tenant_id', None) is not None,
-            'source_profile': config[section].get('source_profile', None),
+            'azure': 'azure_tenant_id' in keys,
+            'source_profile': keys.get('source_profile'),
         }
-        if config[section].get('role_arn', None) is not None:
+        if 'role_arn' in keys:
             new['account'], new['role'] = dissasemble_iam_arn(
-                config[section]['role_arn']
+                keys['role_arn']
             )
-        ret[new['name']] = new
+        ret[name] = new
 
     return ret
 
@@ -95,46 +298,102 @@ def which(exe):
     return os.path.dirname(shutil.which(exe))
 
 
-def create_aws_profiles(aws_config, azure_path=None):
-    """Create aws profiles from a config."""
-    if azure_path is None:
-        azure_path = aws_azure_login_path
+def create_aws_profiles(aws_config, azure_path=None, manifest=None):
+    """Create aws profiles from a config.
+
+    When a manifest is given, profiles whose aws config section didnt change
+    since the last run are reused instead of being generated again. A single
+    login profile is created for every source profile.
+    """
+    return [as_dict(x) for x in iter_aws_profiles(aws_config, azure_path, manifest)]
+
+
+def iter_aws_profiles(aws_config, azure_path=None, manifest=None):
+    """Yield the aws profiles of a config, see create_aws_profiles."""
+    yield from iter_role_profiles(aws_config, manifest)
+    yield from iter_login_profiles(aws_config, azure_path, manifest)
+
+
+def iter_role_profiles(aws_config, manifest=None):
+    """Yield a profile for every profile of the aws config."""
     aws_profiles = aws_config_to_profiles(aws_config)
 
-    profiles = []
     for _, profile in aws_profiles.items():
-        new = mkprofile(
-            profile['name'],
-            source_profile=profile['source_profile'],
-            tags=[
-                profile['account'],
-                profile['role'],
-                profile['source_profile']
-            ],
+        yield cached_profile(
+            manifest, profile['name'], profile,
+            lambda profile=profile: new_aws_profile(
+                profile['name'],
+                source_profile=profile['source_profile'],
+                tags=[
+                    profile['account'],
+                    profile['role'],
+                    profile['source_profile']
+                ],
+            )
         )
-        profiles += [new]
 
+
+def iter_login_profiles(aws_config, azure_path=None, manifest=None):
+    """Yield a login profile for every source profile of the aws config."""
+    if azure_path is None:
+        azure_path = aws_azure_login_path
+    aws_profiles = aws_config_to_profiles(aws_config)
+
+    azure_path = once(azure_path)
+    seen = set()
     for _, profile in aws_profiles.items():
         source_profile = profile.get("source_profile", None)
-        if source_profile is None:
+        if source_profile is None or source_profile in seen:
             continue
-        new = mkprofile(
-            f'login-{source_profile}'
+        seen.add(source_profile)
+        yield cached_profile(
+            manifest, f'login-{source_profile}',
+            aws_profiles[source_profile],
+            lambda source_profile=source_profile: new_login_profile(
+                source_profile, aws_profiles, azure_path
+            )
         )
-        envs = [f'AWS_PROFILE={source_profile}']
-        if aws_profiles[source_profile].get('azure', False):
-            path = azure_path()
-            envs += [f'PATH={path}']
-        node_env = os.getenv('NODE_EXTRA_CA_CERTS', None)
-        if node_env is not None:
-            envs += [f"NODE_EXTRA_CA_CERTS={node_env}"]
-        new["Command"] = f"bash -c '{' '.join(envs)} aws-azure-login --no-prompt || sleep 60'"
-        profiles += [new]
-    return profiles
+
+
+def once(func):
+    """Return a function calling `func` the first time and caching the result."""
+    result = []
+
+    def wrapper():
+        if not result:
+            result.append(func())
+        return result[0]
+    return wrapper
+
+
+def login_profile(source_profile, aws_profiles, azure_path):
+    """Create the login profile for a source profile."""
+    return new_login_profile(source_profile, aws_profiles, azure_path).to_dict()
+
+
+def new_login_profile(source_profile, aws_profiles, azure_path):
+    """Return the login profile for a source profile as a Profile."""
+    new = new_aws_profile(
+        f'login-{source_profile}'
+    )
+    envs = [f'AWS_PROFILE={source_profile}']
+    if aws_profiles[source_profile].get('azure', False):
+        path = azure_path()
+        envs += [f'PATH={path}']
+    node_env = os.getenv('NODE_EXTRA_CA_CERTS', None)
+    if node_env is not None:
+        envs += [f"NODE_EXTRA_CA_CERTS={node_env}"]
+    new["Command"] = f"bash -c '{' '.join(envs)} aws-azure-login --no-prompt || sleep 60'"
+    return new
 
 
 def alt_a_split_profile(dictionary, profile):
-    """Create the split profile."""
+    """Create the split profile.
+
+    The keyboard map is shared between profiles, so it is copied before
+    adding the binding.
+    """
+    dictionary['Keyboard Map'] = dict(dictionary['Keyboard Map'])
     dictionary['Keyboard Map']["0x61-0x80000"] = {
         "Action": 28,
         "Text": profile,
@@ -144,8 +403,16 @@ def alt_a_split_profile(dictionary, profile):
 
 def mkprofile(aws_profile, account=None, role=None, source_profile=None, tags=None):
     """Return a new profile."""
+    return new_aws_profile(
+        aws_profile, account, role, source_profile, tags
+    ).to_dict()
+
+
+def new_aws_profile(aws_profile, account=None, role=None, source_profile=None,
+                    tags=None):
+    """Return a new aws profile as a Profile, see mkprofile."""
     user = os.getenv("USER")
-    ret = create_profile(
+    ret = new_profile(
         aws_profile,
         cmd=f"/usr/bin/env AWS_PROFILE={aws_profile} /usr/bin/login -fp {user}",
         change_title=False,
@@ -174,34 +441,99 @@ def mkprofile(aws_profile, account=None, role=None, source_profile=None, tags=No
     return ret
 
 
+_TEMPLATE = {}
+_TEMPLATE_LOCK = threading.Lock()
+
+
+def profile_template():
+    """Return the sub structures shared by every profile.
+
+    The smart selection rules, triggers and keybinds are built once per run
+    and the same objects are referenced from every profile, so they must not
+    be modified in place. Replace them in the profile instead.
+    """
+    with _TEMPLATE_LOCK:
+        if not _TEMPLATE:
+            _TEMPLATE.update({
+                "Smart Selection Rules": smart_selection_rules(),
+                "Triggers": triggers(),
+                "Keyboard Map": keybinds(),
+            })
+    return _TEMPLATE
+
+
+def reset_profile_template():
+    """Forget the shared profile structures so they are built again."""
+    _TEMPLATE.clear()
+
+
 def create_profile(name, cmd=None, change_title=False, tags=None, badge=True):
     """Create a new profile."""
-    if tags is None:
-        tags = []
+    return new_profile(name, cmd, change_title, tags, badge).to_dict()
+
+
+def new_profile(name, cmd=None, change_title=False, tags=None, badge=True):
+    """Create a new profile as a Profile.
+
+    The profile references the shared structures of profile_template and is
+    only turned into a dict when it is written.
+    """
+    return Profile(name, cmd, change_title, tags, badge, profile_template())
+
+
+INHERITED_KEYS = (
+    "Unlimited Scrollback",
+    "Title Components",
+    "Allow Title Setting",
+    "Smart Selection Rules",
+    "Custom Directory",
+    "Flashing Bell",
+    "Silence Bell",
+    "Triggers",
+    "Keyboard Map",
+)
 
+
+def base_profile(name='pterm-base'):
+    """Create the parent profile holding the settings shared by all profiles."""
+    template = create_profile(name, change_title=False, badge=False)
     ret = {
         "Name": name,
         "Guid": name,
-        "Unlimited Scrollback": True,
-        "Title Components": 32,
-        "Custom Window Title": name,
-        "Allow Title Setting": change_title,
-        "Tags": tags,
-        "Smart Selection Rules": smart_selection_rules(),
-        "Custom Directory": "Recycle",
-        "Flashing Bell": True,
-        "Silence Bell": True,
-        "Triggers": triggers(),
-        "Keyboard Map": keybinds(),
+        "Tags": ['pterm'],
     }
+    for key in INHERITED_KEYS:
+        ret[key] = template[key]
+    return ret
 
-    if badge:
-        ret["Badge Text"] = name
 
-    if cmd is not None:
-        ret["Command"] = cmd
-        ret["Custom Command"] = "Yes"
-    return ret
+def inherit_profiles(profiles, name='pterm-base'):
+    """Make the profiles inherit their shared settings from a base profile.
+
+    Every setting equal to the one of the base profile is removed from the
+    profile and iTerm2 picks it up through `Dynamic Profile Parent Name`.
+    The base profile is returned first, as it has to be defined before the
+    profiles that use it.
+    """
+    return list(iter_inherit_profiles(profiles, name))
+
+
+def iter_inherit_profiles(profiles, name='pterm-base'):
+    """Yield the base profile and the inheriting profiles, see inherit_profiles."""
+    base = base_profile(name)
+    yield base
+    for profile in profiles:
+        if not profile:
+            yield profile
+            continue
+        new = {
+            key: value for key, value in profile.items()
+            if key not in base or key in ('Name', 'Guid', 'Tags') or not (
+                value is base[key] or value == base[key]
+            )
+        }
+        new["Dynamic Profile Parent Name"] = name
+        yield new
 
 
 def keybinds():
@@ -238,15 +570,28 @@ def triggers():
     ]
 
 
+def ssr_path():
+    """Return the path of the user smart selection rules."""
+    return os.path.expanduser('~/.pterm.ssr.json')
+
+
 def smart_selection_rules():
-    """Return the smart selection roles for the profiles."""
-    local = os.path.expanduser('~/.pterm.ssr.json')
-    local_ssr = []
-    if os.path.isfile(local):
-        with open(local) as out:
-            local_ssr = json.load(out)
-
-    return local_ssr + [
+    """Return the smart selection roles for the profiles.
+
+    The rules of ~/.pterm.ssr.json come first. Every rule is validated once,
+    see pterm.rules, and invalid rules are left out.
+    """
+    return [rule for rule, _ in compiled_smart_selection_rules()]
+
+
+def compiled_smart_selection_rules():
+    """Return the smart selection rules with their compiled regexes."""
+    return load_rules(ssr_path(), builtin_smart_selection_rules)
+
+
+def builtin_smart_selection_rules():
+    """Return the smart selection rules shipped with pterm."""
+    return [
         {
             "notes": "terraform aws resource",
             "precision": "normal",
@@ -274,7 +619,7 @@ def smart_selection_rules():
         {
             "notes": "aws acm-pca",
             "precision": "normal",
-            "regex": "arn:aws:acm-pca:([\w-]*):(\d*):certificate-authority/([\w-]*)",
+            "regex": r"arn:aws:acm-pca:([\w-]*):(\d*):certificate-authority/([\w-]*)",
             "actions": [
                 {
                     "title": "open webpage",
@@ -286,7 +631,7 @@ def smart_selection_rules():
         {
             "notes": "aws iam-policy",
             "precision": "normal",
-            "regex": "arn:aws:iam::(\d*):policy/([\w-]*)",
+            "regex": r"arn:aws:iam::(\d*):policy/([\w-]*)",
             "actions": [
                 {
                     "title": "open webpage",
@@ -298,7 +643,7 @@ def smart_selection_rules():
         {
             "notes": "aws iam-role",
             "precision": "normal",
-            "regex": "arn:aws:iam::\d*:role/([\w-_]*)",
+            "regex": r"arn:aws:iam::\d*:role/([\w-]*)",
             "actions": [
                 {
                     "title": "open webpage",
@@ -310,7 +655,7 @@ def smart_selection_rules():
         {
             "notes": "aws lambda",
             "precision": "normal",
-            "regex": "arn:aws:lambda:([\w-]*):\d*:function:([\w-_]*)",
+            "regex": r"arn:aws:lambda:([\w-]*):\d*:function:([\w-]*)",
             "actions": [
                 {
                     "title": "open webpage",
@@ -323,25 +668,23 @@ def smart_selection_rules():
 
 
 def create_k8s_profile(this, cfg, aws_profiles):
-    """Create a kubernetes profile."""
+    """Create a kubernetes profile.
+
+    `aws_profiles` can be the generated aws profiles or their
+    source_profile_index.
+    """
+    return new_k8s_profile(this, cfg, aws_profiles).to_dict()
+
+
+def new_k8s_profile(this, cfg, aws_profiles):
+    """Create a kubernetes profile as a Profile, see create_k8s_profile."""
     user = os.getenv("USER")
-    aws_profile = None
+    aws_profile = k8s_aws_profile(this)
     cluster = this['current-context']
     cmd = [
         "/usr/bin/env",
         f"KUBECONFIG={cfg}",
     ]
-    try:
-        env = this['users'][0]['user']['exec']['env'][0]
-        if env['name'] != 'AWS_PROFILE':
-            pass
-        aws_profile = env['value']
-    except KeyError:
-        pass
-    except TypeError:
-        pass
-    except IndexError:
-        pass
 
     if aws_profile is not None:
         cmd += [f'AWS_PROFILE={aws_profile}']
@@ -352,7 +695,7 @@ def create_k8s_profile(this, cfg, aws_profiles):
         f'{user}',
     ]
 
-    new = create_profile(
+    new = new_profile(
         f'k8s-{cluster}',
         cmd=' '.join(cmd),
         change_title=False,
@@ -373,37 +716,170 @@ def create_k8s_profile(this, cfg, aws_profiles):
     return new
 
 
-def find_source_profile(profile, aws_profiles):
-    """Retrieve the source profile for a profile."""
-    this_aws_profile = [
-        x for x in aws_profiles
-        if x.get('Name') == profile
-    ]
+def _context_field(context, field, default=None):
+    """Return a field of a kubeconfig context."""
+    return (context.get('context') or {}).get(field, default)
+
+
+def yaml_backend():
+    """Return the yaml loader, dumper and the name of their backend.
+
+    The libyaml loader and dumper are used when PyYAML is built with it.
+    """
+    import yaml  # pylint: disable=import-outside-toplevel
+
+    try:
+        return yaml.CSafeLoader, yaml.CSafeDumper, 'libyaml'
+    except AttributeError:
+        return yaml.SafeLoader, yaml.SafeDumper, 'python'
+
+
+@instrumented('yaml load')
+def load_yaml(stream, loader=None):
+    """Load a yaml document, with libyaml if it is available."""
+    import yaml  # pylint: disable=import-outside-toplevel
+
+    return yaml.load(stream, Loader=loader or yaml_backend()[0])
+
+
+@instrumented('yaml dump')
+def dump_yaml(data, stream=None, dumper=None):
+    """Dump a yaml document, with libyaml if it is available."""
+    import yaml  # pylint: disable=import-outside-toplevel
+
+    return yaml.dump(data, stream, Dumper=dumper or yaml_backend()[1])
+
+
+def split_k8s_config(config):
+    """Split a kubeconfig into one config per cluster.
+
+    The clusters, contexts and users are indexed once and every cluster
+    config is a shallow copy of the top level keys with only the entries of
+    that cluster. The context of a cluster is the one named after it, or
+    else the first context using it, and the user is the one the context
+    refers to. Yields tuples of the cluster name and its config.
+    """
+    contexts = {}
+    cluster_contexts = {}
+    for context in config.get('contexts') or []:
+        contexts.setdefault(context['name'], context)
+        cluster = _context_field(context, 'cluster')
+        if cluster is not None:
+            cluster_contexts.setdefault(cluster, context)
+    users = {}
+    for user in config.get('users') or []:
+        users.setdefault(user['name'], user)
+
+    common = {
+        key: value for key, value in config.items()
+        if key not in ('clusters', 'contexts', 'users', 'current-context')
+    }
+
+    for cluster in config.get('clusters') or []:
+        name = cluster['name']
+        context = contexts.get(name)
+        if context is None or _context_field(context, 'cluster', name) != name:
+            context = cluster_contexts.get(name, context)
+
+        user = name
+        if context is not None:
+            user = _context_field(context, 'user', name)
+
+        new = dict(common)
+        new['clusters'] = [cluster]
+        new['contexts'] = [context] if context is not None else []
+        new['users'] = [users[user]] if user in users else []
+        new['current-context'] = context['name'] if context is not None else name
+        yield name, new
+
+
+def k8s_aws_profile(this):
+    """Return the AWS_PROFILE used by a carved k8s cluster config."""
+    aws_profile = None
     try:
-        this_aws_profile = this_aws_profile[0]
+        env = this['users'][0]['user']['exec']['env'][0]
+        if env['name'] != 'AWS_PROFILE':
+            pass
+        aws_profile = env['value']
+    except KeyError:
+        pass
+    except TypeError:
+        pass
     except IndexError:
-        print(f"Error, profile ${profile} not found in aws config")
-        return None
+        pass
+    return aws_profile
 
-    return [
-        x.replace('source_profile_', '')
-        for x in this_aws_profile['Tags']
-        if x is not None and x.startswith('source_profile_')
-    ][0]
+
+def tags_source_profile(profile):
+    """Return the source profile from the tags of a generated profile."""
+    for tag in profile.get('Tags', []):
+        if tag is not None and tag.startswith('source_profile_'):
+            return tag.replace('source_profile_', '')
+    return None
+
+
+def source_profile_index(aws_profiles):
+    """Map the name of every generated aws profile to its source profile."""
+    index = {}
+    for profile in aws_profiles:
+        index.setdefault(profile.get('Name'), tags_source_profile(profile))
+    return index
+
+
+def find_source_profile(profile, aws_profiles):
+    """Retrieve the source profile for a profile.
+
+    `aws_profiles` is either the list of generated aws profiles or an index
+    from source_profile_index, which avoids scanning the list on every call.
+    """
+    if isinstance(aws_profiles, dict):
+        if profile not in aws_profiles:
+            print(f"Error, profile ${profile} not found in aws config")
+            return None
+        return aws_profiles[profile]
+
+    for this_aws_profile in aws_profiles:
+        if this_aws_profile.get('Name') == profile:
+            return tags_source_profile(this_aws_profile)
+
+    print(f"Error, profile ${profile} not found in aws config")
+    return None
+
+
+def sh_command(name):
+    """Return an sh command for an executable."""
+    import sh  # pylint: disable=import-outside-toplevel
+
+    return sh.Command(name)
+
+
+def vault_state():
+    """Return the path, mtime and size of the vault binary, None if missing.
+
+    The vault profile depends on them, as its tags are the vault version.
+    """
+    path = shutil.which('vault')
+    if path is None:
+        return None
+    path = os.path.realpath(path)
+    stat = os.stat(path)
+    return [path, stat.st_mtime_ns, stat.st_size]
 
 
 def create_vault_profile(name):
     """Create a vault profile."""
-    if not HAS_VAULT:
+    if not has_vault():
         return {}
+    with timed('vault'):
+        tags = sh_command('vault')(
+            '--version', _env={'VAULT_CLI_NO_COLOR': "true"}
+        ).strip().split()
     new = create_profile(
         name,
         change_title=False,
         badge=True,
         cmd=f"/bin/bash -c 'PATH={which('vault')} vault server -dev'",
-        tags=vault(
-            '--version', _env={'VAULT_CLI_NO_COLOR': "true"}
-        ).strip().split()
+        tags=tags
     )
     new['Triggers'] = [
         {
@@ -433,41 +909,164 @@ def get_keys_from_file(csv):
     return access, secret
 
 
+def credential_files(paths):
+    """Return the credentials files in `paths`, expanding directories.
+
+    A directory stands for the csv files directly inside it.
+    """
+    if isinstance(paths, str):
+        paths = [paths]
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files += sorted(
+                os.path.join(path, x) for x in os.listdir(path)
+                if x.lower().endswith('.csv')
+            )
+        else:
+            files += [path]
+    return files
+
+
 def cache():
+    """Return the keychain item listing the keys of older pterm versions."""
     return 'pterm-iam-list'
 
-def generate_key_profiles(creds, keychain):
-    """Create the AWS profiles from credentials the user has stored."""
-    ret = []
 
+KEY_WORKERS = 8
+
+
+def generate_key_profiles(creds, keychain, manifest=None, workers=KEY_WORKERS,
+                          identities=None, store=None):
+    """Create the AWS profiles from credentials the user has stored.
+
+    `creds` are credentials files or directories to add first, see
+    import_keys. The keys are listed from the key `store` and, with a
+    manifest, profiles of keys seen in the last run are reused. The keys are
+    resolved by up to `workers` threads and the profiles are returned in the
+    order the keys were added. Keys that fail are reported and skipped.
+    """
+    return list(iter_key_profiles(
+        creds, keychain, manifest, workers, identities, store
+    ))
+
+
+def iter_key_profiles(creds, keychain, manifest=None, workers=KEY_WORKERS,
+                      identities=None, store=None):
+    """Yield the profiles of the stored keys, see generate_key_profiles."""
+    if store is None:
+        store = key_store()
     if creds is not None:
-        profile_from_creds(creds, keychain, cache())
+        import_keys(creds, keychain, store, identities, workers)
+
+    keys = store.keys()
+    if not keys:
+        return
+    refresh = identities is not None and identities.refresh
 
-    arns = security_find(cache())
+    def build(key):
+        alias = None if refresh else key['alias']
+        if alias is None:
+            alias = key_alias(key['arn'], identities)
+            store.set_alias(key['arn'], alias)
+        return profile_from_arn(key['arn'], identities, alias)
 
-    if arns is None:
-        return ret
+    def resolve(key):
+        try:
+            return cached_profile(
+                manifest, key['arn'], key['arn'], lambda: build(key)
+            )
+        except Exception as exc:  # pylint: disable=broad-except
+            print(f"Error, unable to create a profile for {key['arn']}: {exc}",
+                  file=sys.stderr)
+            return None
 
-    for arn in json.loads(arns):
-        ret += [profile_from_arn(arn)]
+    from concurrent.futures import ThreadPoolExecutor  # pylint: disable=import-outside-toplevel
+
+    backend = keychain_backend()
+    missing = [x['arn'] for x in keys if refresh or x['alias'] is None]
+    if missing and hasattr(backend, 'prefetch'):
+        try:
+            backend.prefetch(missing)
+        except Exception as exc:  # pylint: disable=broad-except
+            print(f"Error, unable to read the keychain: {exc}", file=sys.stderr)
+    if workers > 1 and len(keys) > 1:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            for profile in pool.map(resolve, keys):
+                if profile is not None:
+                    yield profile
+    else:
+        for key in keys:
+            profile = resolve(key)
+            if profile is not None:
+                yield profile
 
-    return ret
 
+def import_keys(paths, keychain, store, identities=None, workers=KEY_WORKERS):
+    """Store the keys of many credentials files.
+
+    The ARNs and aliases of the keys are resolved by up to `workers` threads,
+    the secrets are written to the keychain and the metadata of all the keys
+    is added to the `store` in one transaction. Files that fail are reported
+    and skipped. Returns the ARNs of the added keys.
+    """
+    refresh = identities is not None and identities.refresh
 
-def profile_from_creds(creds, keychain, cache):
-    """Create a profile from an AWS credentials file."""
-    access_key, secret_key = get_keys_from_file(creds)
+    def resolve(path):
+        try:
+            access_key, secret_key = get_keys_from_file(path)
+            arn = (not refresh and store.find_arn(access_key)) or cached_identity(
+                identities, access_key, 'arn',
+                lambda: aws_key_name(access_key, secret_key)
+            )
+            alias = cached_identity(
+                identities, access_key, 'alias',
+                lambda: account_aliases(access_key, secret_key)
+            )
+        except Exception as exc:  # pylint: disable=broad-except
+            print(f"Error, unable to add the key of {path}: {exc}",
+                  file=sys.stderr)
+            return None
+        return arn, alias, access_key, secret_key
+
+    from concurrent.futures import ThreadPoolExecutor  # pylint: disable=import-outside-toplevel
+
+    files = credential_files(paths)
+    with ThreadPoolExecutor(max_workers=max(min(workers, len(files)), 1)) as pool:
+        resolved = [x for x in pool.map(resolve, files) if x is not None]
+
+    backend = keychain_backend()
+    if hasattr(backend, 'prefetch'):
+        backend.prefetch(x[0] for x in resolved)
+    for arn, _, access_key, secret_key in resolved:
+        security_store(arn, access_key, secret_key, keychain)
+
+    store.add_many({
+        'arn': arn,
+        'account': dissasemble_iam_arn(arn)[0],
+        'alias': alias,
+        'access_key': access_key,
+    } for arn, alias, access_key, _ in resolved)
+    return [x[0] for x in resolved]
+
+
+def key_alias(arn, identities=None):
+    """Return the account alias of a stored key, using its secret."""
+    _, key, _, secret = re.split("[ =]", security_find(arn))
+    return cached_identity(
+        identities, key, 'alias', lambda: account_aliases(key, secret)
+    )
 
-    arn = security_store(access_key, secret_key, keychain, cache)
-    return profile_from_arn(arn)
 
+def profile_from_arn(arn, identities=None, alias=None):
+    """Create a profile from an ARN.
 
-def profile_from_arn(arn):
-    """Create a profile from an ARN."""
+    The account alias is looked up with the secret of the key unless given.
+    """
     tags = list(dissasemble_iam_arn(arn))
 
-    _, key, _, secret = re.split("[ =]", security_find(arn))
-    alias = account_aliases(key, secret)
+    if alias is None:
+        alias = key_alias(arn, identities)
     if alias != '':
         tags += [alias]
 
@@ -484,9 +1083,12 @@ def profile_from_arn(arn):
     return ret
 
 
+@instrumented('boto3 sts')
 def aws_key_name(access_key, secret_key):
     """Retrieve the arn of the given key."""
-    client = boto3.client(
+    import boto3  # pylint: disable=import-outside-toplevel
+
+    client = boto3.session.Session().client(
         'sts',
         aws_access_key_id=access_key,
         aws_secret_access_key=secret_key,
@@ -496,25 +1098,39 @@ def aws_key_name(access_key, secret_key):
     return response['Arn']
 
 
+_KEYCHAIN = []
+
+
+def keychain_backend():
+    """Return the keychain backend of the run.
+
+    By default this is the macOS keychain, with every item cached after it
+    is read once.
+    """
+    if not _KEYCHAIN:
+        _KEYCHAIN.append(CachedKeychain(SecurityKeychain()))
+    return _KEYCHAIN[0]
+
+
+def set_keychain_backend(backend):
+    """Use `backend` for all the keychain operations."""
+    _KEYCHAIN[:] = [backend]
+
+
 def security_find(name):
     """Find a macOS keychain item with given name.
 
     Returns None if nothing is found.
     """
-    try:
-        return str(security(
-            'find-generic-password',
-            '-a', os.getenv("USER"),
-            '-s', name,
-            '-w'
-        )).rstrip()
-    except sh.ErrorReturnCode_44:  # pylint: disable=no-member
-        return None
+    return keychain_backend().find(name)
 
 
+@instrumented('boto3 iam')
 def account_aliases(access_key, secret_key):
     """Find an AWS account alias."""
-    client = boto3.client(
+    import boto3  # pylint: disable=import-outside-toplevel
+
+    client = boto3.session.Session().client(
         'iam',
         aws_access_key_id=access_key,
         aws_secret_access_key=secret_key,
@@ -529,56 +1145,57 @@ def account_aliases(access_key, secret_key):
     return ''
 
 
-def security_store(access_key, secret_key, keychain, cache):
-    """Store the AWS credentials in the macOS keychain.
+def security_store(arn, access_key, secret_key, keychain):
+    """Store the AWS credentials of a key in the macOS keychain.
 
-    An entry is also added in the cache keychain entry, see
-    security_add_to_list.
+    The item is only written if the secret changed.
     """
-    name = aws_key_name(access_key, secret_key)
     data = f"AWS_ACCESS_KEY_ID={access_key} AWS_SECRET_KEY_ID={secret_key}"
-    existing_key = security_find(name)
+    existing_key = security_find(arn)
 
     if existing_key == data:
-        return name
-
-    security(
-        'add-generic-password',
-        '-a', os.getenv("USER"),
-        '-s', name,
-        '-w', data,
-        keychain
-    )
+        return arn
 
-    security_add_to_list(name, keychain, cache)
+    if existing_key is not None:
+        keychain_backend().delete(arn)
+    keychain_backend().add(arn, data, keychain)
 
-    return name
+    return arn
 
 
-def security_add_to_list(name, keychain, cache):
-    """Add a key in the keychain cache.
+_KEY_STORE = []
 
-    MacOS doesnt allow to list all the secrets so a list is maintaind for
-    pterm to allow adding all profiles that were created via cmd line
+
+def key_store():
+    """Return the key store of the run.
+
+    A new store is filled with the key list older versions of pterm kept in
+    the keychain, see migrate_key_list.
     """
-    data = security_find(cache)
+    if not _KEY_STORE:
+        store = KeyStore()
+        if store.created and has_security():
+            migrate_key_list(store)
+        _KEY_STORE.append(store)
+    return _KEY_STORE[0]
 
-    if data is not None:
-        security(
-            'delete-generic-password', '-a', os.getenv("USER"), '-s', cache
-        )
-        data = json.loads(data)
-    else:
-        data = []
 
-    data += [name]
+def set_key_store(store):
+    """Use `store` for the keys."""
+    _KEY_STORE[:] = [store]
 
-    security(
-        'add-generic-password',
-        '-a', os.getenv("USER"),
-        '-s', cache,
-        '-w', json.dumps(data),
-        keychain
-    )
 
-    return data
+def migrate_key_list(store):
+    """Add the keys of the keychain list of older pterm versions to `store`.
+
+    Their aliases are looked up when their profiles are first created. The
+    keychain item is left in place.
+    """
+    data = security_find(cache())
+    if data is None:
+        return []
+    arns = json.loads(data)
+    store.add_many(
+        {'arn': x, 'account': dissasemble_iam_arn(x)[0]} for x in arns
+    )
+    return arns
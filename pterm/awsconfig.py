@@ -0,0 +1,142 @@
+"""Single pass parser of the aws config.
+
+The aws config is read once per run and the parsed sections are shared
+between sorting it and generating the profiles. The parser follows the
+configparser rules pterm relies on (comments, `=` and `:` delimiters,
+lowercase keys and indented continuation lines) without interpolation.
+"""
+
+import os
+import threading
+
+COMMENT_PREFIXES = ('#', ';')
+
+_CACHE = {}
+_LOCK = threading.Lock()
+# Held while a config is parsed, so concurrent loads of it parse it once.
+_PATH_LOCKS = {}
+
+
+def parse(text, source='<string>'):
+    """Return the sections of an aws config as dicts of their keys."""
+    sections = {}
+    values = {}
+    current = None
+    option = None
+    indent_level = 0
+
+    for lineno, line in enumerate(text.splitlines(), 1):
+        value = line.strip()
+        if not value:
+            if option is not None:
+                values[option] += ['']
+            continue
+        if value.startswith(COMMENT_PREFIXES):
+            continue
+
+        indent = len(line) - len(line.lstrip())
+        if option is not None and indent > indent_level:
+            values[option] += [value]
+            continue
+
+        indent_level = indent
+        if value[0] == '[' and value.rfind(']') > 1:
+            _join(current, values)
+            name = value[1:value.rindex(']')]
+            current = sections.setdefault(name, {})
+            values = {}
+            option = None
+            continue
+
+        if current is None:
+            raise ValueError(f'{source}:{lineno}: expected a [section], got {value!r}')
+
+        equal, colon = value.find('='), value.find(':')
+        index = colon if equal < 0 or 0 <= colon < equal else equal
+        if index <= 0:
+            raise ValueError(f'{source}:{lineno}: expected key = value, got {value!r}')
+        option = value[:index].rstrip().lower()
+        values[option] = [value[index + 1:].lstrip()]
+
+    _join(current, values)
+    return sections
+
+
+def _join(section, values):
+    """Store the multi line `values` in `section`."""
+    for key, lines in values.items():
+        section[key] = '\n'.join(lines).rstrip()
+
+
+def profile_name(section):
+    """Return the profile name of a section, or None for other sections.
+
+    `[default]` is the default profile and `[profile name]` a named one,
+    while sections like `[sso-session name]` aren't profiles.
+    """
+    if section == 'default':
+        return section
+    kind, _, name = section.partition(' ')
+    if kind != 'profile' or not name.strip():
+        return None
+    return name.strip()
+
+
+def load(path):
+    """Return the parsed sections of the aws config at `path`.
+
+    The result is cached until the file changes and must not be modified.
+    Concurrent loads of the same file wait for a single parse. Like
+    configparser, a missing file has no sections.
+    """
+    with _LOCK:
+        lock = _PATH_LOCKS.setdefault(path, threading.Lock())
+    with lock:
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return {}
+        key = (stat.st_mtime_ns, stat.st_size)
+        with _LOCK:
+            cached = _CACHE.get(path)
+        if cached is not None and cached[0] == key:
+            return cached[1]
+
+        with open(path, 'r') as config:
+            sections = parse(config.read(), path)
+        with _LOCK:
+            _CACHE[path] = (key, sections)
+        return sections
+
+
+def store(path, sections):
+    """Cache `sections` as the content just written to `path`."""
+    stat = os.stat(path)
+    with _LOCK:
+        _CACHE[path] = ((stat.st_mtime_ns, stat.st_size), sections)
+
+
+def clear_cache():
+    """Forget the parsed configs."""
+    with _LOCK:
+        _CACHE.clear()
+
+
+def sort(sections):
+    """Return the sections and their keys ordered alphabetically."""
+    return {
+        name: dict(sorted(sections[name].items()))
+        for name in sorted(sections)
+    }
+
+
+def dumps(sections):
+    """Return the sections in the format written by configparser."""
+    lines = []
+    for name, keys in sections.items():
+        lines += [f'[{name}]\n']
+        for key, value in keys.items():
+            value = value.replace('\n', '\n\t')
+            lines += [f'{key} = {value}\n']
+        lines += ['\n']
+    return ''.join(lines)
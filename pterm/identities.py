@@ -0,0 +1,88 @@
+"""On disk cache of the AWS identities resolved from stored keys.
+
+Entries are keyed by a hash of the access key id and hold the ARN and the
+account alias of the key, so a normal run doesnt need to call AWS. The
+secret key is never stored.
+"""
+
+import os
+import json
+import time
+import hashlib
+import threading
+
+DEFAULT_TTL = 7 * 24 * 60 * 60
+
+
+def identity_cache_path():
+    """Return the default path of the identity cache."""
+    return os.path.join(
+        os.path.expanduser(os.getenv('XDG_CACHE_HOME', '~/.cache')),
+        'pterm',
+        'identities.json'
+    )
+
+
+def key_fingerprint(access_key):
+    """Return the cache key for an access key id."""
+    return hashlib.sha256(access_key.encode()).hexdigest()
+
+
+class IdentityCache:
+    """Resolved ARNs and account aliases of access keys."""
+
+    def __init__(self, path=None, ttl=DEFAULT_TTL, refresh=False):
+        self.path = path or identity_cache_path()
+        self.ttl = ttl
+        self.refresh = refresh
+        self.dirty = False
+        self._lock = threading.Lock()
+        try:
+            with open(self.path) as out:
+                self.entries = json.load(out)
+        except (OSError, ValueError):
+            self.entries = {}
+
+    def get(self, access_key, field):
+        """Return a cached field of a key, None if missing or expired."""
+        if self.refresh:
+            return None
+        with self._lock:
+            entry = self.entries.get(key_fingerprint(access_key), {})
+            value = entry.get(field)
+        if value is None or time.time() - value['time'] > self.ttl:
+            return None
+        return value['value']
+
+    def put(self, access_key, field, value):
+        """Store a field of a key."""
+        with self._lock:
+            entry = self.entries.setdefault(key_fingerprint(access_key), {})
+            entry[field] = {'value': value, 'time': time.time()}
+            self.dirty = True
+
+    def resolve(self, access_key, field, resolve):
+        """Return a field of a key, calling `resolve` if it isnt cached."""
+        value = self.get(access_key, field)
+        if value is None:
+            value = resolve()
+            self.put(access_key, field, value)
+        return value
+
+    def save(self):
+        """Write the cache to disk if it changed."""
+        from pterm import atomic_write  # pylint: disable=import-outside-toplevel
+
+        with self._lock:
+            if not self.dirty:
+                return
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            atomic_write(self.path, json.dumps(self.entries).encode())
+            self.dirty = False
+
+
+def cached_identity(cache, access_key, field, resolve):
+    """Resolve a field of a key through the cache if there is one."""
+    if cache is None:
+        return resolve()
+    return cache.resolve(access_key, field, resolve)
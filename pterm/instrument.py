@@ -0,0 +1,148 @@
+"""Lightweight timing of the stages of a run and of external calls.
+
+Nothing is recorded until enable() is called, so the instrumentation costs
+a flag check when it is off. Every record keeps the number of calls, the
+total wall time and, when memory tracing is on, the highest memory traced
+during one of the calls above the memory in use when it started.
+"""
+
+import json
+import time
+import functools
+import itertools
+import threading
+import contextlib
+import tracemalloc
+
+_STATE = {
+    'enabled': False,
+    'memory': False,
+}
+_STATS = {}
+_LOCK = threading.Lock()
+
+# The highest traced memory seen by every running timed block. The tracemalloc
+# peak is folded into all of them and reset whenever a block starts or ends,
+# so nested and concurrent blocks each get the peak of their own lifetime.
+# Before python 3.9 the peak cant be reset and the blocks get the peak since
+# the tracing started.
+_ACTIVE = {}
+_TOKENS = itertools.count()
+_RESET_PEAK = hasattr(tracemalloc, 'reset_peak')
+
+
+def enable(memory=False):
+    """Start recording, tracing the memory allocations too if `memory`."""
+    _STATE['enabled'] = True
+    _STATE['memory'] = memory
+    if memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+
+def disable():
+    """Stop recording and forget the records."""
+    _STATE['enabled'] = False
+    if _STATE['memory'] and tracemalloc.is_tracing():
+        tracemalloc.stop()
+    _STATE['memory'] = False
+    with _LOCK:
+        _STATS.clear()
+        _ACTIVE.clear()
+
+
+def _fold_peak():
+    """Fold the traced peak into the running blocks and reset it."""
+    current, peak = tracemalloc.get_traced_memory()
+    for token in _ACTIVE:
+        _ACTIVE[token] = max(_ACTIVE[token], peak)
+    tracemalloc.reset_peak()
+    return current
+
+
+def _start_peak():
+    """Start tracking the peak memory of a block, see _end_peak."""
+    if not _STATE['memory'] or not tracemalloc.is_tracing():
+        return None
+    if not _RESET_PEAK:
+        return None, 0
+    with _LOCK:
+        current = _fold_peak()
+        token = next(_TOKENS)
+        _ACTIVE[token] = current
+    return token, current
+
+
+def _end_peak(started):
+    """Return the peak memory of a block above the memory at its start."""
+    if started is None or not tracemalloc.is_tracing():
+        return None
+    token, current = started
+    if token is None:
+        return tracemalloc.get_traced_memory()[1]
+    with _LOCK:
+        _fold_peak()
+        return _ACTIVE.pop(token, current) - current
+
+
+def record(name, elapsed, calls=1, peak=None):
+    """Add `calls` calls taking `elapsed` seconds to the record of `name`.
+
+    `peak` is the memory allocated by the calls at their highest, in bytes.
+    """
+    if not _STATE['enabled']:
+        return
+    with _LOCK:
+        stat = _STATS.setdefault(name, {'calls': 0, 'time': 0.0, 'peak': None})
+        stat['calls'] += calls
+        stat['time'] += elapsed
+        if peak is not None:
+            stat['peak'] = max(stat['peak'] or 0, peak)
+
+
+@contextlib.contextmanager
+def timed(name):
+    """Record the time spent in the block as a call of `name`."""
+    if not _STATE['enabled']:
+        yield
+        return
+    started = _start_peak()
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        record(name, elapsed, peak=_end_peak(started))
+
+
+def instrumented(name):
+    """Decorate a function to record every call to it as `name`."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with timed(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def stats():
+    """Return a copy of the records."""
+    with _LOCK:
+        return {x: dict(y) for x, y in _STATS.items()}
+
+
+def summary():
+    """Return the records as the lines of a table."""
+    ret = [f"{'stage':24} {'calls':>7} {'total ms':>10} {'peak MiB':>9}"]
+    for name, stat in stats().items():
+        peak = '' if stat['peak'] is None else f"{stat['peak'] / 1024 / 1024:9.2f}"
+        ret += [
+            f"{name:24} {stat['calls']:7} {stat['time'] * 1000:10.1f} {peak:>9}"
+        ]
+    return ret
+
+
+def write_stats(path):
+    """Write the records to a json file."""
+    with open(path, 'w') as out:
+        json.dump(stats(), out, indent=4)
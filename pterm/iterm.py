@@ -0,0 +1,219 @@
+"""Batch client for the iTerm2 API.
+
+A single websocket connection to iTerm2 is shared by all the operations of
+a run. Every request carries an id that its response is matched with, so
+several operations are in flight at the same time, and profiles are listed
+with only the properties pterm needs instead of all of them.
+
+iterm2, for the protobuf messages, and websockets are only imported when a
+client connects.
+"""
+
+import os
+import sys
+import json
+import asyncio
+import itertools
+
+DEFAULT_URI = 'ws://localhost:1912'
+SUBPROTOCOL = 'api.iterm2.com'
+
+# The profile properties that are pushed to the running iTerm2.
+LIVE_PROPERTIES = ('Badge Text', 'Background Color', 'Tags')
+
+
+def headers():
+    """Return the headers authenticating a script with iTerm2.
+
+    They are the headers the iterm2 library sends, iTerm2 checks its version.
+    """
+    from iterm2._version import __version__  # pylint: disable=import-outside-toplevel
+
+    ret = {
+        'origin': 'ws://localhost/',
+        'x-iterm2-library-version': f'python {__version__}',
+    }
+    for name, env in (('x-iterm2-cookie', 'ITERM2_COOKIE'),
+                      ('x-iterm2-key', 'ITERM2_KEY')):
+        if os.getenv(env) is not None:
+            ret[name] = os.getenv(env)
+    return ret
+
+
+async def open_websocket(uri):
+    """Open a websocket to iTerm2 with the old and new websockets APIs."""
+    # pylint: disable=import-outside-toplevel
+    try:
+        from websockets.asyncio.client import connect
+        options = {'additional_headers': headers()}
+    except ImportError:
+        from websockets import connect
+        options = {'extra_headers': headers()}
+    return await connect(
+        uri, subprotocols=[SUBPROTOCOL], ping_interval=None, **options
+    )
+
+
+def errors():
+    """Return the exceptions of a failed connection or request to iTerm2."""
+    ret = (OSError, RuntimeError)
+    try:
+        from websockets.exceptions import WebSocketException  # pylint: disable=import-outside-toplevel
+    except ImportError:
+        return ret
+    return ret + (WebSocketException,)
+
+
+class Client:
+    """A connection to iTerm2 running concurrent requests."""
+
+    def __init__(self, websocket):
+        from iterm2 import api_pb2  # pylint: disable=import-outside-toplevel
+
+        self.api = api_pb2
+        self.websocket = websocket
+        self.requests = 0
+        self._ids = itertools.count(1)
+        self._pending = {}
+        self._reader = asyncio.ensure_future(self._read())
+
+    @classmethod
+    async def connect(cls, uri=DEFAULT_URI):
+        """Connect to iTerm2, or to a server speaking its protocol at `uri`."""
+        return cls(await open_websocket(uri))
+
+    async def close(self):
+        """Close the connection."""
+        self._reader.cancel()
+        await self.websocket.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *_):
+        await self.close()
+
+    async def _read(self):
+        """Resolve the pending requests with their responses."""
+        error = None
+        try:
+            while True:
+                message = self.api.ServerOriginatedMessage()
+                message.ParseFromString(await self.websocket.recv())
+                future = self._pending.pop(message.id, None)
+                if future is not None and not future.done():
+                    future.set_result(message)
+        except asyncio.CancelledError:
+            raise
+        except Exception as exc:  # pylint: disable=broad-except
+            error = exc
+        finally:
+            for future in self._pending.values():
+                if not future.done():
+                    future.set_exception(
+                        ConnectionError(f'iTerm2 connection closed: {error}')
+                    )
+            self._pending.clear()
+
+    async def call(self, request):
+        """Send a ClientOriginatedMessage and return the response."""
+        request.id = next(self._ids)
+        future = asyncio.get_running_loop().create_future()
+        self._pending[request.id] = future
+        self.requests += 1
+        await self.websocket.send(request.SerializeToString())
+        response = await future
+        if response.HasField('error'):
+            raise RuntimeError(f'iTerm2 request failed: {response.error}')
+        return response
+
+    async def list_profiles(self, properties, guids=None):
+        """Return the `properties` of the profiles, of all or of `guids`."""
+        request = self.api.ClientOriginatedMessage()
+        request.list_profiles_request.SetInParent()
+        request.list_profiles_request.properties.extend(properties)
+        if guids is not None:
+            request.list_profiles_request.guids.extend(guids)
+        response = await self.call(request)
+        return [
+            {x.key: json.loads(x.json_value) for x in profile.properties}
+            for profile in response.list_profiles_response.profiles
+        ]
+
+    async def set_default(self, guid):
+        """Make the profile `guid` the default profile."""
+        request = self.api.ClientOriginatedMessage()
+        this = request.preferences_request.requests.add()
+        this.set_default_profile_request.guid = guid
+        response = await self.call(request)
+        for result in response.preferences_response.results:
+            status = result.set_default_profile_result.status
+            if status != self.api.PreferencesResponse.Result.SetDefaultProfileResult.OK:
+                raise RuntimeError(f'iTerm2 cant make {guid} the default profile')
+
+    async def set_properties(self, guid, properties):
+        """Set the `properties` of the profile `guid`."""
+        request = self.api.ClientOriginatedMessage()
+        this = request.set_profile_property_request
+        this.guid_list.guids.append(guid)
+        for key, value in properties.items():
+            assignment = this.assignments.add()
+            assignment.key = key
+            assignment.json_value = json.dumps(value)
+        response = await self.call(request)
+        status = response.set_profile_property_response.status
+        if status != self.api.SetProfilePropertyResponse.OK:
+            raise RuntimeError(f'iTerm2 cant update the profile {guid}')
+
+
+def live_updates(old, new, keys=LIVE_PROPERTIES):
+    """Return the changed `keys` of the profiles in both `old` and `new`.
+
+    The result maps the Guid of every changed profile to its new values.
+    """
+    old = {x.get('Guid'): x for x in old}
+    updates = {}
+    for profile in new:
+        previous = old.get(profile.get('Guid'))
+        if previous is None:
+            continue
+        changed = {
+            key: profile[key] for key in keys
+            if key in profile and profile[key] != previous.get(key)
+        }
+        if changed:
+            updates[profile['Guid']] = changed
+    return updates
+
+
+async def sync(client, default=None, updates=None):
+    """Set the `default` profile and apply `updates` concurrently.
+
+    `default` is a profile name and `updates` maps profile Guids to their new
+    properties. Only the names and Guids of the profiles are fetched, and
+    profiles iTerm2 doesnt know about are skipped. Returns the updated Guids.
+    """
+    updates = updates or {}
+    profiles = await client.list_profiles(['Guid', 'Name'])
+    known = {x.get('Guid') for x in profiles}
+
+    operations = []
+    if default is not None:
+        guids = [x.get('Guid') for x in profiles if x.get('Name') == default]
+        if guids:
+            operations += [client.set_default(guids[0])]
+        else:
+            print(f'Error, profile {default} not found in iTerm2',
+                  file=sys.stderr)
+    updated = [x for x in updates if x in known]
+    operations += [client.set_properties(x, updates[x]) for x in updated]
+    await asyncio.gather(*operations)
+    return updated
+
+
+def run(default=None, updates=None, uri=DEFAULT_URI):
+    """Connect to iTerm2 and sync, see sync."""
+    async def session():
+        async with await Client.connect(uri) as client:
+            return await sync(client, default, updates)
+    return asyncio.run(session())
@@ -0,0 +1,191 @@
+"""Keychain backends for the secrets pterm manages.
+
+SecurityKeychain talks to the macOS keychain through the `security` binary
+and reads many items with a single `security -i` process. MemoryKeychain
+keeps the items in memory, for tests and benchmarks. CachedKeychain wraps a
+backend and keeps every item it read or wrote for the rest of the run.
+"""
+
+import os
+import time
+import threading
+
+from pterm.instrument import instrumented
+
+
+class Keychain:
+    """Interface of the keychain backends."""
+
+    def find(self, name):
+        """Return the secret stored as `name`, None if missing."""
+        return self.find_many([name])[name]
+
+    def find_many(self, names):
+        """Return a dict with the secret, or None, of each name."""
+        raise NotImplementedError
+
+    def add(self, name, secret, keychain=None):
+        """Store `secret` as `name`."""
+        raise NotImplementedError
+
+    def delete(self, name):
+        """Delete the item `name`."""
+        raise NotImplementedError
+
+
+class SecurityKeychain(Keychain):
+    """The macOS keychain, through the `security` binary."""
+
+    def __init__(self, account=None):
+        self.account = account or os.getenv("USER")
+
+    @staticmethod
+    @instrumented('security')
+    def _security(*args, **kwargs):
+        import sh  # pylint: disable=import-outside-toplevel
+
+        return sh.Command('security')(*args, **kwargs)
+
+    def find(self, name):
+        import sh  # pylint: disable=import-outside-toplevel
+
+        try:
+            return str(self._security(
+                'find-generic-password',
+                '-a', self.account,
+                '-s', name,
+                '-w'
+            )).rstrip()
+        except sh.ErrorReturnCode_44:  # pylint: disable=no-member
+            return None
+
+    def find_many(self, names):
+        """Read all the items with one `security -i` process.
+
+        The output of every lookup is followed by the output of
+        `default-keychain`, which is used as a separator. Missing items
+        print nothing on stdout. If `security` fails or its output has no
+        separator, the items are read one at a time instead.
+        """
+        import sh  # pylint: disable=import-outside-toplevel
+
+        names = list(names)
+        if len(names) < 2:
+            return {x: self.find(x) for x in names}
+
+        commands = ['default-keychain']
+        for name in names:
+            commands += [
+                f'find-generic-password -a "{self.account}" -s "{name}" -w',
+                'default-keychain',
+            ]
+        try:
+            output = str(self._security('-i', _in='\n'.join(commands) + '\n'))
+        except sh.ErrorReturnCode:
+            output = ''
+
+        lines = [
+            x.replace('security> ', '').rstrip()
+            for x in output.splitlines()
+        ]
+        lines = [x for x in lines if x]
+        if not lines:
+            return {x: self.find(x) for x in names}
+        separator = lines[0]
+
+        ret = {}
+        current = []
+        results = []
+        for line in lines[1:]:
+            if line == separator:
+                results += ['\n'.join(current) if current else None]
+                current = []
+            else:
+                current += [line]
+        for name, secret in zip(names, results):
+            ret[name] = secret
+        for name in names[len(results):]:
+            ret[name] = self.find(name)
+        return ret
+
+    def add(self, name, secret, keychain=None):
+        args = [
+            'add-generic-password',
+            '-a', self.account,
+            '-s', name,
+            '-w', secret,
+        ]
+        if keychain is not None:
+            args += [keychain]
+        self._security(*args)
+
+    def delete(self, name):
+        self._security(
+            'delete-generic-password', '-a', self.account, '-s', name
+        )
+
+
+class MemoryKeychain(Keychain):
+    """A keychain in memory.
+
+    Every call sleeps `latency` seconds to simulate spawning `security`, and
+    is counted in `calls`.
+    """
+
+    def __init__(self, items=None, latency=0):
+        self.items = dict(items or {})
+        self.latency = latency
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def _call(self):
+        with self._lock:
+            self.calls += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def find_many(self, names):
+        self._call()
+        return {x: self.items.get(x) for x in names}
+
+    def add(self, name, secret, keychain=None):
+        self._call()
+        self.items[name] = secret
+
+    def delete(self, name):
+        self._call()
+        self.items.pop(name, None)
+
+
+class CachedKeychain(Keychain):
+    """Keep the items of a backend read or written during the run."""
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.items = {}
+        self._lock = threading.Lock()
+
+    def find_many(self, names):
+        names = list(names)
+        with self._lock:
+            missing = [x for x in names if x not in self.items]
+        if missing:
+            found = self.backend.find_many(missing)
+            with self._lock:
+                self.items.update(found)
+        with self._lock:
+            return {x: self.items[x] for x in names}
+
+    def prefetch(self, names):
+        """Read all the `names` in one batch."""
+        self.find_many(names)
+
+    def add(self, name, secret, keychain=None):
+        self.backend.add(name, secret, keychain)
+        with self._lock:
+            self.items[name] = secret
+
+    def delete(self, name):
+        self.backend.delete(name)
+        with self._lock:
+            self.items[name] = None
@@ -0,0 +1,117 @@
+"""Local store of the keys added with --add.
+
+The ARN, account and alias of every key live in a small sqlite database, so
+listing the keys and creating their profiles never touches the keychain,
+which only holds the secrets. Keys are also indexed by a hash of their
+access key id, so adding a known key again doesnt call AWS. Secrets are
+never stored here.
+"""
+
+import os
+import time
+import sqlite3
+import threading
+
+from pterm.identities import key_fingerprint
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS keys (
+    arn TEXT PRIMARY KEY,
+    account TEXT,
+    alias TEXT,
+    fingerprint TEXT,
+    added REAL
+);
+CREATE INDEX IF NOT EXISTS keys_fingerprint ON keys (fingerprint);
+CREATE INDEX IF NOT EXISTS keys_account ON keys (account);
+'''
+
+FIELDS = ('arn', 'account', 'alias', 'fingerprint', 'added')
+
+
+def keystore_path():
+    """Return the default path of the key store."""
+    return os.path.join(
+        os.path.expanduser(os.getenv('XDG_DATA_HOME', '~/.local/share')),
+        'pterm',
+        'keys.sqlite'
+    )
+
+
+class KeyStore:
+    """The metadata of the stored keys, in the order they were added.
+
+    `created` is True if the database didnt exist before.
+    """
+
+    def __init__(self, path=None):
+        self.path = path or keystore_path()
+        if self.path != ':memory:':
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self.created = self.path == ':memory:' or not os.path.exists(self.path)
+        self._lock = threading.Lock()
+        self.db = sqlite3.connect(self.path, check_same_thread=False)
+        with self.db:
+            self.db.executescript(SCHEMA)
+
+    def keys(self):
+        """Return the stored keys as dicts."""
+        with self._lock:
+            rows = self.db.execute(
+                f"SELECT {', '.join(FIELDS)} FROM keys ORDER BY rowid"
+            ).fetchall()
+        return [dict(zip(FIELDS, x)) for x in rows]
+
+    def arns(self):
+        """Return the ARNs of the stored keys."""
+        return [x['arn'] for x in self.keys()]
+
+    def find_arn(self, access_key):
+        """Return the ARN of an access key id, None if it isnt stored."""
+        with self._lock:
+            row = self.db.execute(
+                'SELECT arn FROM keys WHERE fingerprint = ?',
+                (key_fingerprint(access_key),)
+            ).fetchone()
+        return row and row[0]
+
+    def add_many(self, keys):
+        """Add or update keys in a single transaction.
+
+        `keys` are dicts with the arn, account and alias of a key and its
+        access key id as `access_key`, which can be None. Updated keys keep
+        their position.
+        """
+        now = time.time()
+        rows = [
+            (
+                x['arn'], x.get('account'), x.get('alias'),
+                x.get('access_key') and key_fingerprint(x['access_key']),
+            )
+            for x in keys
+        ]
+        with self._lock, self.db:
+            self.db.executemany(
+                'INSERT OR IGNORE INTO keys (arn, added) VALUES (?, ?)',
+                [(x[0], now) for x in rows]
+            )
+            self.db.executemany(
+                'UPDATE keys SET account = ?, '
+                'alias = COALESCE(?, alias), '
+                'fingerprint = COALESCE(?, fingerprint) '
+                'WHERE arn = ?',
+                [(account, alias, fingerprint, arn)
+                 for arn, account, alias, fingerprint in rows]
+            )
+
+    def set_alias(self, arn, alias):
+        """Record the account alias of a key."""
+        with self._lock, self.db:
+            self.db.execute(
+                'UPDATE keys SET alias = ? WHERE arn = ?', (alias, arn)
+            )
+
+    def close(self):
+        """Close the database."""
+        with self._lock:
+            self.db.close()
@@ -0,0 +1,218 @@
+"""Manifest of the inputs and profiles of the last pterm run.
+
+The manifest lives next to the ``--dest`` file and allows pterm to skip the
+regeneration completely when none of its inputs changed, or to reuse the
+previously generated profiles whose sources did not change.
+"""
+
+import os
+import json
+import hashlib
+import threading
+
+
+def manifest_path(dest):
+    """Return the manifest path for a destination file.
+
+    The file is hidden so that iTerm2 doesnt try to load it as a dynamic
+    profile.
+    """
+    return os.path.join(
+        os.path.dirname(dest),
+        f".{os.path.basename(dest)}.pterm-manifest"
+    )
+
+
+def fingerprint(obj):
+    """Return a stable hash for a json serialisable object."""
+    data = json.dumps(obj, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(data.encode()).hexdigest()
+
+
+def file_hash(path):
+    """Return the sha256 of a file."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as out:
+        for chunk in iter(lambda: out.read(1 << 16), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _hashes(inputs):
+    """Return the content hash of each input."""
+    return {
+        path: state and state['sha256']
+        for path, state in inputs.items()
+    }
+
+
+def file_state(path, previous=None):
+    """Return the mtime, size and hash of a file.
+
+    The hash is reused from `previous` when the mtime and size didnt change,
+    so an untouched file is never read. Missing files have a state of None.
+    """
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+
+    state = {
+        'mtime': stat.st_mtime_ns,
+        'size': stat.st_size,
+    }
+    if previous and all(previous.get(x) == state[x] for x in state):
+        state['sha256'] = previous['sha256']
+    else:
+        state['sha256'] = file_hash(path)
+    return state
+
+
+class Manifest:
+    """Inputs and per profile fingerprints of a pterm run.
+
+    `outputs` are the files the profiles are written to, the `dest` file or
+    its shards, and `files` the other files the profiles need by Guid, like
+    the split kubeconfigs.
+    """
+
+    def __init__(self, path, dest, data=None):
+        self.path = path
+        self.dest = dest
+        self.data = data or {}
+        self.inputs = {}
+        self.options = {}
+        self.shared = []
+        self.profiles = {}
+        self.outputs = [dest]
+        self.files = {}
+        self._previous = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def load(cls, dest):
+        """Load the manifest for `dest`, returning an empty one if missing."""
+        path = manifest_path(dest)
+        try:
+            with open(path) as out:
+                data = json.load(out)
+        except (OSError, ValueError):
+            data = {}
+        return cls(path, dest, data)
+
+    def scan(self, inputs, options, shared=()):
+        """Record the state of the input files and the run options.
+
+        A change to any of the `shared` inputs invalidates every profile.
+        """
+        previous = self.data.get('inputs', {})
+        self.inputs = {
+            path: file_state(path, previous.get(path))
+            for path in list(inputs) + list(shared)
+        }
+        self.options = options
+        self.shared = list(shared)
+
+    def unchanged(self):
+        """Return True if the inputs and options match the last run."""
+        outputs = list(self.data.get('outputs', [self.dest]))
+        outputs += [
+            x for files in self.data.get('files', {}).values() for x in files
+        ]
+        if not all(os.path.exists(x) for x in outputs):
+            return False
+
+        return (
+            self.data.get('options') == self.options and
+            _hashes(self.data.get('inputs', {})) == _hashes(self.inputs)
+        )
+
+    def _reusable(self):
+        """Return True if the previous profiles can be reused."""
+        previous = _hashes(self.data.get('inputs', {}))
+        current = _hashes(self.inputs)
+        return self.data.get('options') == self.options and all(
+            previous.get(x) == current.get(x) for x in self.shared
+        )
+
+    def previous_profiles(self):
+        """Return the profiles of the current output files by Guid."""
+        with self._lock:
+            if self._previous is None:
+                self._previous = {}
+                if self._reusable():
+                    for path in self.data.get('outputs', [self.dest]):
+                        try:
+                            with open(path) as out:
+                                current = json.load(out)
+                        except (OSError, ValueError):
+                            continue
+                        self._previous.update(
+                            (x['Guid'], x) for x in current.get('Profiles', [])
+                            if 'Guid' in x
+                        )
+        return self._previous
+
+    def profile(self, guid, source, build, files=()):
+        """Return the profile for `guid`, building it only if `source` changed.
+
+        `source` is anything json serialisable that the profile is generated
+        from, `build` the function that generates it and `files` the files
+        the profile uses, which must exist to skip a run.
+        """
+        digest = fingerprint(source)
+        self.profiles[guid] = digest
+        if files:
+            self.files[guid] = list(files)
+        if self.data.get('profiles', {}).get(guid) == digest:
+            previous = self.previous_profiles().get(guid)
+            if previous is not None:
+                return previous
+        return build()
+
+    def keep(self, guids):
+        """Carry over the fingerprints of profiles reused without a rebuild."""
+        previous = self.data.get('profiles', {})
+        files = self.data.get('files', {})
+        for guid in guids:
+            if guid in previous:
+                self.profiles[guid] = previous[guid]
+            if guid in files:
+                self.files[guid] = files[guid]
+
+    def written_files(self):
+        """Return the files used by the profiles of the previous runs.
+
+        These are the files of the last run and the files of the profiles
+        removed before, which werent deleted yet.
+        """
+        files = self.data.get('files', {}).values()
+        return sorted(
+            {x for paths in files for x in paths} |
+            set(self.data.get('stale', []))
+        )
+
+    def save(self):
+        """Write the manifest to disk."""
+        current = {x for files in self.files.values() for x in files}
+        data = {
+            'inputs': self.inputs,
+            'options': self.options,
+            'outputs': self.outputs,
+            'files': self.files,
+            'stale': [
+                x for x in self.written_files()
+                if x not in current and os.path.exists(x)
+            ],
+            'profiles': self.profiles,
+        }
+        with open(self.path, 'w') as out:
+            json.dump(data, out, indent=4, sort_keys=True)
+        self.data = data
+
+
+def cached_profile(manifest, guid, source, build, files=()):
+    """Build a profile through the manifest if there is one."""
+    if manifest is None:
+        return build()
+    return manifest.profile(guid, source, build, files)
@@ -0,0 +1,53 @@
+"""Stages for streams of profiles.
+
+A stage is a function that takes an iterable of profiles and returns
+another one, so the producers, stages and sinks only ever hold the profile
+that is being processed.
+"""
+
+
+def pipeline(source, *stages):
+    """Feed the profiles of `source` through each stage in turn."""
+    for stage in stages:
+        source = stage(source)
+    return source
+
+
+def filter_stage(predicate):
+    """Return a stage keeping the profiles `predicate` is true for."""
+    def stage(profiles):
+        return (x for x in profiles if predicate(x))
+    return stage
+
+
+def transform_stage(func):
+    """Return a stage replacing every profile with `func(profile)`."""
+    def stage(profiles):
+        return (func(x) for x in profiles)
+    return stage
+
+
+def tap_stage(func):
+    """Return a stage calling `func` for every profile it passes on."""
+    def stage(profiles):
+        for profile in profiles:
+            func(profile)
+            yield profile
+    return stage
+
+
+class Counter:
+    """A stage counting the profiles that go through it."""
+
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, profiles):
+        for profile in profiles:
+            self.count += 1
+            yield profile
+
+
+def collect(profiles):
+    """Sink returning the profiles as a list."""
+    return list(profiles)
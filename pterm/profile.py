@@ -0,0 +1,153 @@
+"""Compact model of the generated iTerm2 profiles.
+
+A Profile keeps the per profile values in slots and references the smart
+selection rules, triggers and keybinds shared by all profiles, instead of a
+dict repeating every key. It reads and writes like the dict create_profile
+returns, keeping the key order of that dict, and is only turned into a dict
+when the profiles are written.
+"""
+
+from collections.abc import MutableMapping
+
+# The keys of a new profile in the order iTerm2 gets them, with their slots.
+LAYOUT = (
+    ('Name', 'name'),
+    ('Guid', 'guid'),
+    ('Unlimited Scrollback', 'unlimited_scrollback'),
+    ('Title Components', 'title_components'),
+    ('Custom Window Title', 'title'),
+    ('Allow Title Setting', 'change_title'),
+    ('Tags', 'tags'),
+    ('Smart Selection Rules', 'rules'),
+    ('Custom Directory', 'directory'),
+    ('Flashing Bell', 'flashing_bell'),
+    ('Silence Bell', 'silence_bell'),
+    ('Triggers', 'triggers'),
+    ('Keyboard Map', 'keymap'),
+    ('Badge Text', 'badge'),
+    ('Command', 'command'),
+    ('Custom Command', 'custom_command'),
+)
+SLOTS = dict(LAYOUT)
+
+
+class _Missing:
+    """Marker of a key the profile doesnt have."""
+
+    __slots__ = ()
+
+    def __repr__(self):
+        return 'MISSING'
+
+
+MISSING = _Missing()
+
+
+class Profile(MutableMapping):
+    """An iTerm2 profile.
+
+    Keys outside LAYOUT, and keys of LAYOUT set after being missing, are kept
+    in `extra` in the order they were set, like a dict would.
+    """
+
+    __slots__ = tuple(SLOTS.values()) + ('extra',)
+
+    def __init__(self, name, cmd=None, change_title=False, tags=None,
+                 badge=True, template=None):
+        template = template or {}
+        self.name = name
+        self.guid = name
+        self.unlimited_scrollback = True
+        self.title_components = 32
+        self.title = name
+        self.change_title = change_title
+        self.tags = [] if tags is None else tags
+        self.rules = template.get('Smart Selection Rules', MISSING)
+        self.directory = 'Recycle'
+        self.flashing_bell = True
+        self.silence_bell = True
+        self.triggers = template.get('Triggers', MISSING)
+        self.keymap = template.get('Keyboard Map', MISSING)
+        self.badge = name if badge else MISSING
+        self.command = MISSING if cmd is None else cmd
+        self.custom_command = MISSING if cmd is None else 'Yes'
+        self.extra = None
+
+    def __getitem__(self, key):
+        slot = SLOTS.get(key)
+        if slot is not None:
+            value = getattr(self, slot)
+            if value is not MISSING:
+                return value
+        if self.extra is not None and key in self.extra:
+            return self.extra[key]
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        slot = SLOTS.get(key)
+        if slot is not None and getattr(self, slot) is not MISSING:
+            setattr(self, slot, value)
+            return
+        if self.extra is None:
+            self.extra = {}
+        self.extra[key] = value
+
+    def __delitem__(self, key):
+        slot = SLOTS.get(key)
+        if slot is not None and getattr(self, slot) is not MISSING:
+            setattr(self, slot, MISSING)
+        elif self.extra is not None and key in self.extra:
+            del self.extra[key]
+        else:
+            raise KeyError(key)
+
+    def __iter__(self):
+        for key, slot in LAYOUT:
+            if getattr(self, slot) is not MISSING:
+                yield key
+        if self.extra is not None:
+            yield from self.extra
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __eq__(self, other):
+        if isinstance(other, Profile) and self.values_tuple() == other.values_tuple():
+            return True
+        return super().__eq__(other)
+
+    __hash__ = None
+
+    def __repr__(self):
+        return f'Profile({self.to_dict()!r})'
+
+    def values_tuple(self):
+        """Return the values of the profile, cheap to compare."""
+        return tuple(getattr(self, x) for x in self.__slots__)
+
+    def copy(self):
+        """Return a shallow copy of the profile."""
+        new = Profile.__new__(Profile)
+        for slot in self.__slots__:
+            setattr(new, slot, getattr(self, slot))
+        if self.extra is not None:
+            new.extra = dict(self.extra)
+        return new
+
+    def to_dict(self):
+        """Return the profile as the dict written to iTerm2."""
+        ret = {}
+        for key, slot in LAYOUT:
+            value = getattr(self, slot)
+            if value is not MISSING:
+                ret[key] = value
+        if self.extra is not None:
+            ret.update(self.extra)
+        return ret
+
+
+def as_dict(profile):
+    """Return a Profile as a dict, leaving dicts as they are."""
+    if isinstance(profile, Profile):
+        return profile.to_dict()
+    return profile
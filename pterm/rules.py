@@ -0,0 +1,118 @@
+"""Validated smart selection rules.
+
+iTerm2 evaluates every smart selection rule on every selection, so the rules
+are compiled once when the profiles are generated. iTerm2 runs the rules
+with ICU regular expressions, which accept syntax python doesnt, like \\p{L}
+or \\Q...\\E, so user rules python cant compile are only reported, while the
+builtin rules must compile. Rules without a regex or with an invalid
+precision are dropped and rules prone to catastrophic backtracking are
+reported. The validated rules are cached until the user rules file changes.
+"""
+
+import os
+import re
+import sys
+import json
+import threading
+
+PRECISIONS = ('very_low', 'low', 'normal', 'high', 'very_high')
+
+# A group containing an unbounded quantifier that is itself repeated, like
+# (a+)+ or (\w+\s?)*, which can backtrack exponentially.
+NESTED_QUANTIFIER = re.compile(
+    r'\((?:[^()\\]|\\.)*(?:[+*]|\{\d*,\})(?:[^()\\]|\\.)*\)(?:[+*]|\{\d*,\})'
+)
+
+_CACHE = {}
+_LOCK = threading.Lock()
+
+
+def rule_name(rule):
+    """Return a name for a rule in messages."""
+    if isinstance(rule, dict):
+        return rule.get('notes') or rule.get('regex')
+    return repr(rule)
+
+
+def check_rule(rule, strict=False):
+    """Validate a rule.
+
+    Returns the compiled regex, or None, and a list of the errors and a list
+    of the warnings found. A regex python cant compile is an error if
+    `strict` and a warning otherwise.
+    """
+    if not isinstance(rule, dict) or not isinstance(rule.get('regex'), str):
+        return None, ['missing regex'], []
+
+    errors = []
+    warnings = []
+    try:
+        pattern = re.compile(rule['regex'])
+    except re.error as exc:
+        pattern = None
+        if strict:
+            errors += [f'invalid regex: {exc}']
+        else:
+            warnings += [f'regex not supported by python, kept for iTerm2: {exc}']
+
+    if rule.get('precision', 'normal') not in PRECISIONS:
+        errors += [f"invalid precision {rule['precision']}"]
+    if NESTED_QUANTIFIER.search(rule['regex']):
+        warnings += ['nested quantifiers can cause catastrophic backtracking']
+    return pattern, errors, warnings
+
+
+def compile_rules(rules, strict=False):
+    """Compile a list of rules.
+
+    Returns a list of tuples of the rule and its compiled regex, which is
+    None for regexes only iTerm2 understands. Invalid rules are dropped and
+    reported on stderr, or raise a ValueError if `strict`, see check_rule.
+    """
+    ret = []
+    for rule in rules:
+        pattern, errors, warnings = check_rule(rule, strict)
+        for warning in warnings:
+            print(f"Warning, smart selection rule {rule_name(rule)}: {warning}",
+                  file=sys.stderr)
+        if errors:
+            message = f"smart selection rule {rule_name(rule)}: {', '.join(errors)}"
+            if strict:
+                raise ValueError(message)
+            print(f"Error, {message}", file=sys.stderr)
+            continue
+        ret += [(rule, pattern)]
+    return ret
+
+
+def load_rules(path, builtin):
+    """Return the compiled user rules of `path` followed by the `builtin` ones.
+
+    The builtin rules are checked strictly, see compile_rules. The result is
+    cached by the mtime of `path`, so the file is only read and validated
+    again after it changes.
+    """
+    try:
+        mtime = os.stat(path).st_mtime_ns
+    except OSError:
+        mtime = None
+
+    key = (path, mtime)
+    with _LOCK:
+        if key in _CACHE:
+            return _CACHE[key]
+
+        local = []
+        if mtime is not None:
+            with open(path) as out:
+                local = json.load(out)
+        rules = compile_rules(local) + compile_rules(builtin(), strict=True)
+        _CACHE.clear()
+        _CACHE[key] = rules
+        return rules
+
+
+def clear_cache():
+    """Forget the validated rules."""
+    with _LOCK:
+        _CACHE.clear()
@@ -0,0 +1,109 @@
+"""Run the profile sources of pterm concurrently.
+
+Every source runs in its own thread, as they mostly wait on files,
+subprocesses and AWS. The profiles are merged in the order the sources were
+added, so the output doesnt depend on which one finishes first. The profiles
+of the source whose turn it is are passed on as soon as they are created,
+only the profiles of the later sources wait in a queue, and the profiles are
+only kept after the run for the sources other sources depend on. Without
+`concurrent` the sources run one after the other in the calling thread, for
+profilers that only see the thread they are started in.
+"""
+
+import queue
+from concurrent.futures import Future
+from concurrent.futures import ThreadPoolExecutor
+
+from pterm.instrument import timed
+
+# Marks the end of the profiles of a source in its queue.
+_DONE = object()
+
+
+class Scheduler:
+    """Concurrent profile sources merged in a fixed order.
+
+    `keep` are the names of the sources whose profiles result() returns, all
+    of them if None. `owners` maps the Guid of every profile yielded to the
+    name of its source.
+    """
+
+    def __init__(self, concurrent=True, keep=None):
+        self.concurrent = concurrent
+        self.keep = keep
+        self.tasks = []
+        self.owners = {}
+        self._futures = {}
+
+    def add(self, name, source):
+        """Add a source, a function returning an iterable of profiles."""
+        self.tasks += [(name, source)]
+
+    def keeps(self, name):
+        """Return True if the profiles of the source `name` are kept."""
+        return self.keep is None or name in self.keep
+
+    def result(self, name):
+        """Wait for a source and return its profiles.
+
+        Sources can use this to depend on a source added before them, if it
+        is kept. Raises ValueError for the sources that aren't.
+        """
+        if not self.keeps(name):
+            raise ValueError(f'the profiles of {name} are not kept')
+        return self._futures[name].result()
+
+    def _run(self, name, source, out):
+        """Put the profiles of a source in the `out` queue."""
+        kept = [] if self.keeps(name) else None
+        try:
+            with timed(f'source {name}'):
+                for profile in source():
+                    out.put(profile)
+                    if kept is not None:
+                        kept.append(profile)
+            return kept
+        finally:
+            out.put(_DONE)
+
+    def _yield(self, name, profile):
+        self.owners.setdefault(profile.get('Guid'), name)
+        return profile
+
+    def _run_serial(self):
+        """Run the sources in order in the calling thread."""
+        for name, source in self.tasks:
+            future = Future()
+            self._futures[name] = future
+            kept = [] if self.keeps(name) else None
+            try:
+                with timed(f'source {name}'):
+                    for profile in source():
+                        if kept is not None:
+                            kept.append(profile)
+                        yield self._yield(name, profile)
+            except Exception as exc:
+                future.set_exception(exc)
+                raise
+            future.set_result(kept)
+
+    def run(self):
+        """Start all the sources and yield their profiles in order."""
+        if not self.concurrent:
+            yield from self._run_serial()
+            return
+        queues = {name: queue.Queue() for name, _ in self.tasks}
+        with ThreadPoolExecutor(max_workers=max(len(self.tasks), 1)) as pool:
+            for name, source in self.tasks:
+                self._futures[name] = pool.submit(
+                    self._run, name, source, queues[name]
+                )
+            for name, _ in self.tasks:
+                while True:
+                    profile = queues[name].get()
+                    if profile is _DONE:
+                        break
+                    yield self._yield(name, profile)
+                del queues[name]
+                # raise the error of a failed source
+                self._futures[name].result()
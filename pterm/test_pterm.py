@@ -8,13 +8,18 @@ from pterm import triggers
 from pterm import create_k8s_profile
 from pterm import find_source_profile
 from pterm import generate_key_profiles
+import json
 import random
 import re
 import os
+import threading
+import time
 import yaml
 import pterm
 import pytest
 
+account_aliases_orig = pterm.account_aliases
+
 try:
     from sh import security
 except ImportError:
@@ -201,6 +206,66 @@ def test_sort_aws_config_dry():
     assert new_config == expected
 
 
+def test_aws_config_sections(monkeypatch):
+    case = '''
+        # comment
+        [default]
+        Region = eu-west-1
+        [sso-session corp]
+        sso_start_url = https://corp.awsapps.com/start
+        [profile b]
+        role_arn: arn:aws:iam::123456789012:role/admin
+        source_profile = default
+        s3 =
+            max_concurrent_requests = 20
+
+            max_queue_size = 1000
+        [profile a]
+        azure_tenant_id = foo
+    '''
+    config = create_config(case)
+    sections = pterm.awsconfig.load(config)
+
+    assert list(sections) == ['default', 'sso-session corp', 'profile b', 'profile a']
+    assert sections['default'] == {'region': 'eu-west-1'}
+    assert sections['profile b']['s3'] == \
+        '\nmax_concurrent_requests = 20\n\nmax_queue_size = 1000'
+    assert pterm.awsconfig.load(config) is sections
+
+    profiles = aws_config_to_profiles(config)
+    assert list(profiles) == ['default', 'b', 'a']
+    assert profiles['b']['account'] == '123456789012'
+    assert profiles['b']['source_profile'] == 'default'
+    assert profiles['a']['azure']
+
+    sort_aws_config(config)
+    assert list(pterm.awsconfig.load(config)) == \
+        ['default', 'profile a', 'profile b', 'sso-session corp']
+    assert pterm.awsconfig.parse(open(config).read()) == pterm.awsconfig.load(config)
+    assert list(aws_config_to_profiles(config)) == ['default', 'a', 'b']
+
+    with pytest.raises(ValueError):
+        pterm.awsconfig.parse('region = eu-west-1')
+
+    # concurrent sources share a single parse
+    from concurrent.futures import ThreadPoolExecutor
+
+    parses = []
+    parse = pterm.awsconfig.parse
+
+    def slow_parse(*args):
+        parses.append(args)
+        time.sleep(0.05)
+        return parse(*args)
+
+    pterm.awsconfig.clear_cache()
+    monkeypatch.setattr(pterm.awsconfig, 'parse', slow_parse)
+    with ThreadPoolExecutor(max_workers=4) as pool:
+        loaded = list(pool.map(pterm.awsconfig.load, [config] * 4))
+    assert len(parses) == 1
+    assert all(x is loaded[0] for x in loaded)
+
+
 def test_create_k8s_profiles():
     case = '''
         [profile aws-profile]
@@ -280,6 +345,8 @@ def test_find_source_profile():
 
     for profile, profiles, result in cases:
         assert find_source_profile(profile, profiles) == result
+        index = pterm.source_profile_index(profiles)
+        assert find_source_profile(profile, index) == result
 
     pass
 
@@ -294,7 +361,7 @@ def account_aliases(access, secret):
     return "awsalias"
 
 def test_generate_key_profiles():
-    if not pterm.HAS_SECURITY:
+    if not pterm.has_security():
         pytest.skip("Unable to find security binary")
 
     creds = tempfile.NamedTemporaryFile('w', delete=False)
@@ -313,9 +380,813 @@ admin,,AKIxxxxxxxxxxxxxxxNS,YiiKxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxx1ULY,h""", file=
     pterm.cache = cache
     pterm.account_aliases = account_aliases
 
-    res = generate_key_profiles(creds.name, "login.keychain-db")
+    from pterm.keystore import KeyStore
+    store = KeyStore(os.path.join(tempfile.mkdtemp(), 'keys.sqlite'))
+
+    res = generate_key_profiles(creds.name, "login.keychain-db", store=store)
     assert res[0]['Name'] == aws_key_name(None, None)
 
-    # ensure the cache item is picked up if we run the function without a creds file
-    res = generate_key_profiles(None,  "login.keychain-db")
+    # ensure the stored key is picked up if we run the function without a creds file
+    res = generate_key_profiles(None,  "login.keychain-db", store=store)
     assert res[0]['Name'] == aws_key_name(None, None)
+
+
+def test_manifest():
+    from pterm.manifest import Manifest
+
+    aws_config = create_config('''
+        [profile 1]
+        [profile 2]
+        source_profile = 1
+    ''')
+    dest = tempfile.NamedTemporaryFile(delete=False).name
+
+    manifest = Manifest.load(dest)
+    manifest.scan([aws_config], {'version': 1})
+    profiles = create_aws_profiles(aws_config, azure_path, manifest)
+    with open(dest, 'w') as out:
+        json.dump({'Profiles': profiles}, out)
+    manifest.save()
+
+    manifest = Manifest.load(dest)
+    manifest.scan([aws_config], {'version': 1})
+    assert manifest.unchanged()
+
+    manifest.scan([aws_config], {'version': 2})
+    assert not manifest.unchanged()
+
+    with open(aws_config, 'a') as out:
+        out.write('[profile 3]\n')
+
+    built = []
+    original = pterm.new_aws_profile
+
+    def new_aws_profile(*args, **kwargs):
+        built.append(args[0])
+        return original(*args, **kwargs)
+
+    pterm.new_aws_profile = new_aws_profile
+    try:
+        manifest = Manifest.load(dest)
+        manifest.scan([aws_config], {'version': 1})
+        assert not manifest.unchanged()
+        profiles = create_aws_profiles(aws_config, azure_path, manifest)
+    finally:
+        pterm.new_aws_profile = original
+
+    assert built == ['3']
+    assert [x['Name'] for x in profiles] == ['1', '2', '3', 'login-1']
+
+    manifest.outputs = pterm.write_shards(dest, {'aws': profiles})
+    manifest.save()
+    manifest = Manifest.load(dest)
+    manifest.scan([aws_config], {'version': 1})
+    assert manifest.unchanged()
+    assert set(manifest.previous_profiles()) == {x['Guid'] for x in profiles}
+    pterm.remove_files(manifest.data['outputs'])
+    assert not manifest.unchanged()
+
+    # the files a profile uses, like a split kubeconfig, must exist too
+    kubeconfig = os.path.join(os.path.dirname(dest), 'config.cluster-1.yml')
+    with open(kubeconfig, 'w') as out:
+        out.write('{}')
+    manifest.outputs = pterm.write_shards(dest, {'aws': profiles})
+    manifest.profile('k8s-cluster-1', [kubeconfig], dict, files=[kubeconfig])
+    manifest.save()
+    manifest = Manifest.load(dest)
+    manifest.scan([aws_config], {'version': 1})
+    assert manifest.unchanged()
+    os.unlink(kubeconfig)
+    assert not manifest.unchanged()
+    manifest.keep(['k8s-cluster-1'])
+    assert manifest.files == {'k8s-cluster-1': [kubeconfig]}
+
+    # the files of removed profiles are remembered until they are deleted
+    open(kubeconfig, 'w').close()
+    for expected in [[kubeconfig], [kubeconfig], []]:
+        if not expected:
+            os.unlink(kubeconfig)
+        manifest = Manifest.load(dest)
+        manifest.scan([aws_config], {'version': 1})
+        manifest.save()
+        assert Manifest.load(dest).written_files() == expected
+
+
+def test_profile_template_shared():
+    pterm.reset_profile_template()
+    first = pterm.create_profile('first')
+    second = pterm.create_profile('second')
+
+    for key in ['Smart Selection Rules', 'Triggers', 'Keyboard Map']:
+        assert first[key] is second[key]
+
+    pterm.alt_a_split_profile(first, 'login-first')
+    assert '0x61-0x80000' in first['Keyboard Map']
+    assert '0x61-0x80000' not in second['Keyboard Map']
+    assert '0x61-0x80000' not in pterm.create_profile('third')['Keyboard Map']
+
+
+def test_inherit_profiles():
+    profiles = [
+        pterm.create_profile('default', change_title=True, badge=False),
+        pterm.mkprofile('prod', source_profile='source'),
+    ]
+    inherited = pterm.inherit_profiles(profiles)
+
+    base = inherited[0]
+    assert base['Name'] == 'pterm-base'
+    assert 'Smart Selection Rules' in base
+
+    default, prod = inherited[1:]
+    for profile in inherited[1:]:
+        assert profile['Dynamic Profile Parent Name'] == 'pterm-base'
+        assert 'Smart Selection Rules' not in profile
+        assert 'Triggers' not in profile
+    assert default['Allow Title Setting'] is True
+    assert prod['Keyboard Map']['0x61-0x80000']['Text'] == 'login-source'
+    assert prod['Badge Text'] == 'prod'
+    assert 'Background Color' in prod
+
+
+def test_split_k8s_config():
+    config = cluster_config('foo')
+    bar = cluster_config('bar', aws_profile='bar-profile')
+    for key in ['clusters', 'contexts', 'users']:
+        config[key] += bar[key]
+    config['clusters'] += [{'name': 'orphan', 'cluster': {'server': 'orphan'}}]
+
+    split = dict(pterm.split_k8s_config(config))
+    assert list(split) == ['foo-name', 'bar-name', 'orphan']
+
+    foo = split['foo-name']
+    assert foo['clusters'] == config['clusters'][:1]
+    assert foo['contexts'][0]['name'] == 'foo-name'
+    assert foo['users'][0]['name'] == 'foo-user'
+    assert foo['current-context'] == 'foo-name'
+    assert foo['preferences'] is config['preferences']
+    assert pterm.k8s_aws_profile(split['bar-name']) == 'bar-profile'
+
+    orphan = split['orphan']
+    assert orphan['contexts'] == []
+    assert orphan['users'] == []
+    assert orphan['current-context'] == 'orphan'
+    assert len(config['clusters']) == 3
+
+
+def test_write_if_changed():
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, 'config.foo.yml')
+
+    assert pterm.write_if_changed(path, 'foo')
+    os.utime(path, (0, 0))
+    assert not pterm.write_if_changed(path, 'foo')
+    assert os.stat(path).st_mtime == 0
+    assert pterm.write_if_changed(path, 'bar')
+    assert open(path).read() == 'bar'
+    assert os.listdir(directory) == ['config.foo.yml']
+
+    stale = os.path.join(directory, 'config.stale.yml')
+    other = os.path.join(directory, 'other.yml')
+    mine = os.path.join(directory, 'config.mine.yml')
+    for name in [stale, other, mine]:
+        open(name, 'w').close()
+    written = [path, stale, other, os.path.join(directory, 'config.gone.yml')]
+    assert pterm.prune_k8s_configs(written, [path]) == [stale]
+    assert sorted(os.listdir(directory)) == [
+        'config.foo.yml', 'config.mine.yml', 'other.yml',
+    ]
+
+
+def test_yaml_backend():
+    assert pterm.yaml_backend()[2] in ['libyaml', 'python']
+    config = cluster_config('foo')
+    assert pterm.load_yaml(pterm.dump_yaml(config)) == config
+    assert pterm.dump_yaml(config) == yaml.dump(config)
+
+
+def test_generate_key_profiles_concurrent(monkeypatch, capsys):
+    from pterm.keychain import MemoryKeychain
+
+    from pterm.keystore import KeyStore
+
+    arns = [f'arn:aws:iam::{x}:user/pytest' for x in range(20)]
+    store = KeyStore(':memory:')
+    store.add_many({'arn': x, 'alias': ''} for x in arns)
+
+    def profile_from_arn(arn, identities=None, alias=None):
+        time.sleep(random.random() / 100)
+        if arn == arns[3]:
+            raise ValueError('broken key')
+        return {'Name': arn}
+
+    monkeypatch.setattr(pterm, 'profile_from_arn', profile_from_arn)
+    monkeypatch.setattr(pterm, '_KEYCHAIN', [MemoryKeychain()])
+
+    expected = [x for x in arns if x != arns[3]]
+    for workers in [1, 8]:
+        res = generate_key_profiles(
+            None, 'login.keychain-db', workers=workers, store=store
+        )
+        assert [x['Name'] for x in res] == expected
+        assert 'broken key' in capsys.readouterr().err
+
+
+def test_identity_cache(monkeypatch):
+    import boto3
+    from botocore.stub import Stubber
+    from pterm.identities import IdentityCache
+
+    client = boto3.client(
+        'iam',
+        region_name='us-east-1',
+        aws_access_key_id='AKIATEST',
+        aws_secret_access_key='secret',
+    )
+    stubber = Stubber(client)
+    stubber.add_response(
+        'list_account_aliases',
+        {'AccountAliases': ['awsalias'], 'IsTruncated': False},
+    )
+    monkeypatch.setattr(
+        boto3.session.Session, 'client', lambda *args, **kwargs: client
+    )
+    monkeypatch.setattr(pterm, 'account_aliases', account_aliases_orig)
+
+    path = os.path.join(tempfile.mkdtemp(), 'pterm', 'identities.json')
+    identities = IdentityCache(path)
+
+    def alias():
+        return identities.resolve(
+            'AKIATEST', 'alias',
+            lambda: pterm.account_aliases('AKIATEST', 'secret')
+        )
+
+    with stubber:
+        assert alias() == 'awsalias'
+        assert alias() == 'awsalias'
+    stubber.assert_no_pending_responses()
+    identities.save()
+
+    data = open(path).read()
+    assert 'AKIATEST' not in data
+    assert 'secret' not in data
+
+    assert IdentityCache(path).get('AKIATEST', 'alias') == 'awsalias'
+    assert IdentityCache(path, ttl=-1).get('AKIATEST', 'alias') is None
+    assert IdentityCache(path, refresh=True).get('AKIATEST', 'alias') is None
+
+
+def test_security_keychain(monkeypatch):
+    import sh
+    from pterm.keychain import SecurityKeychain
+
+    keychain = '    "/Users/pytest/Library/Keychains/login.keychain-db"'
+    items = {'a': 'secret-a', 'c': 'secret-c'}
+    calls = []
+
+    def security(*args, **kwargs):
+        calls.append(args[0])
+        if args[0] == '-i':
+            assert kwargs['_in'].count('find-generic-password') == 3
+            return mode(kwargs['_in'])
+        name = args[args.index('-s') + 1]
+        if name not in items:
+            raise sh.ErrorReturnCode_44('security', b'', b'not found')
+        return items[name] + '\n'
+
+    def canned(_):
+        # the output of `security -i`, b is missing
+        return '\n'.join([
+            f'security> {keychain}', 'security> secret-a', f'security> {keychain}',
+            f'security> {keychain}', 'security> secret-c', f'security> {keychain}',
+        ]) + '\n'
+
+    def failed(_):
+        raise sh.ErrorReturnCode_1('security -i', b'', b'failed')
+
+    monkeypatch.setattr(SecurityKeychain, '_security', staticmethod(security))
+    expected = {'a': 'secret-a', 'b': None, 'c': 'secret-c'}
+    for mode, processes in ((canned, 1), (lambda _: '', 4), (failed, 4)):
+        calls.clear()
+        assert SecurityKeychain('pytest').find_many(['a', 'b', 'c']) == expected
+        assert len(calls) == processes
+
+
+def test_key_store(monkeypatch, capsys):
+    from pterm.keychain import CachedKeychain, MemoryKeychain
+    from pterm.keystore import KeyStore
+
+    arns = [f'arn:aws:iam::{x}:user/pytest' for x in range(20)]
+    memory = MemoryKeychain({
+        pterm.cache(): json.dumps(arns[:10]),
+    })
+    for arn in arns[:10]:
+        memory.items[arn] = f'AWS_ACCESS_KEY_ID={arn} AWS_SECRET_KEY_ID=secret'
+
+    monkeypatch.setattr(pterm, 'aws_key_name', lambda key, _: arns[int(key[3:])])
+    monkeypatch.setattr(pterm, 'account_aliases', lambda *_: 'awsalias')
+    monkeypatch.setattr(pterm, '_KEYCHAIN', [])
+    pterm.set_keychain_backend(CachedKeychain(memory))
+
+    store = KeyStore(os.path.join(tempfile.mkdtemp(), 'keys.sqlite'))
+    assert store.created
+    assert pterm.migrate_key_list(store) == arns[:10]
+    assert [x['alias'] for x in store.keys()] == [None] * 10
+    assert store.keys()[0]['account'] == '0'
+
+    directory = tempfile.mkdtemp()
+    for index in range(10, 20):
+        with open(os.path.join(directory, f'{index}.csv'), 'w') as out:
+            out.write(
+                'User name,Password,Access key ID,Secret access key,Console login link\n'
+                f'admin,,AKI{index},secret{index},h\n'
+            )
+    with open(os.path.join(directory, 'notes.txt'), 'w') as out:
+        out.write('not a key')
+    broken = create_config('User name,Password,Access key ID\n')
+
+    memory.calls = 0
+    res = generate_key_profiles(
+        [directory, broken], 'login.keychain-db', workers=4, store=store
+    )
+    assert [x['Name'] for x in res] == arns
+    assert all('awsalias' in x['Tags'] for x in res)
+    assert f'Error, unable to add the key of {broken}' in capsys.readouterr().err
+    assert store.arns() == arns
+    assert {x['alias'] for x in store.keys()} == {'awsalias'}
+    assert store.find_arn('AKI15') == arns[15]
+    assert memory.items[arns[15]] == 'AWS_ACCESS_KEY_ID=AKI15 AWS_SECRET_KEY_ID=secret15'
+    assert json.loads(memory.items[pterm.cache()]) == arns[:10]
+    # a batched read of the new and the migrated keys and a write per secret
+    assert memory.calls == 12
+
+    memory.calls = 0
+    pterm.set_keychain_backend(CachedKeychain(memory))
+    res = generate_key_profiles(None, 'login.keychain-db', workers=4, store=store)
+    assert len(res) == len(arns)
+    assert memory.calls == 0
+
+    monkeypatch.setattr(pterm, 'aws_key_name', None)
+    assert pterm.import_keys([directory], 'login.keychain-db', store) == arns[10:]
+    assert memory.calls == 1
+    assert KeyStore(store.path).arns() == arns
+
+
+def test_diff_profiles():
+    old = [
+        {'Guid': 'same', 'Name': 'same'},
+        {'Guid': 'gone', 'Name': 'gone'},
+        {'Guid': 'changed', 'Name': 'changed', 'Tags': ['a'], 'Badge Text': 'x'},
+    ]
+    new = [
+        {'Guid': 'same', 'Name': 'same'},
+        {'Guid': 'changed', 'Name': 'changed', 'Tags': ['b'], 'Command': 'ls'},
+        {'Guid': 'new', 'Name': 'new'},
+    ]
+    diff = pterm.diff_profiles(old, new)
+    assert diff == {
+        'added': ['new'],
+        'removed': ['gone'],
+        'changed': {'changed': ['Badge Text', 'Command', 'Tags']},
+    }
+    assert pterm.format_diff(diff) == [
+        '+ new', '- gone', '~ changed: Badge Text, Command, Tags',
+    ]
+
+
+def test_write_profiles():
+    directory = tempfile.mkdtemp()
+    dest = os.path.join(directory, 'aws-profiles.json')
+    profiles = [pterm.mkprofile('1'), pterm.mkprofile('2-prod')]
+
+    for case in [[], profiles[:1], profiles]:
+        pterm.write_profiles(dest, iter(case))
+        assert open(dest).read() == json.dumps({'Profiles': case}, indent=4)
+
+        pterm.write_profiles(dest, iter(case), compact=True)
+        assert json.load(open(dest)) == {'Profiles': case}
+
+    assert os.listdir(directory) == ['aws-profiles.json']
+
+
+def test_write_shards():
+    directory = tempfile.mkdtemp()
+    dest = os.path.join(directory, 'aws-profiles.json')
+    pterm.write_profiles(dest, [pterm.mkprofile('old')])
+    with open(os.path.join(directory, 'aws-profiles.other.json'), 'w') as out:
+        out.write('{}')
+
+    shards = {
+        'aws': [pterm.mkprofile('1')],
+        'k8s': [pterm.mkprofile('k8s')],
+        'default': [pterm.create_profile('pterm-default')],
+    }
+    written = pterm.write_shards(dest, shards)
+    assert written == [pterm.shard_path(dest, x) for x in ('aws', 'k8s', 'default')]
+    assert sorted(os.listdir(directory)) == [
+        'aws-profiles.aws.json', 'aws-profiles.default.json',
+        'aws-profiles.k8s.json', 'aws-profiles.other.json',
+    ]
+    assert json.load(open(written[0])) == {'Profiles': shards['aws']}
+
+    mtimes = {x: os.stat(x).st_mtime_ns for x in written}
+    shards['k8s'] = [pterm.mkprofile('k8s'), pterm.mkprofile('k8s-2')]
+    del shards['aws']
+    pterm.write_shards(dest, shards)
+    assert not os.path.exists(written[0])
+    assert os.stat(written[1]).st_mtime_ns != mtimes[written[1]]
+    assert os.stat(written[2]).st_mtime_ns == mtimes[written[2]]
+
+    with pytest.raises(ValueError):
+        pterm.write_shards(dest, {'other': []})
+
+    # the base profile has to be loaded before the profiles inheriting it
+    shards = {
+        'keys': [pterm.mkprofile('key')],
+        'aws': [pterm.mkprofile('1')],
+        'login': [pterm.mkprofile('login-1')],
+        'k8s': [pterm.mkprofile('k8s')],
+        'default': [pterm.create_profile('pterm-default')],
+        'base': [pterm.base_profile()],
+    }
+    written = pterm.write_shards(dest, shards)
+    assert written[0] == pterm.shard_path(dest, 'base')
+    assert sorted(written)[0] == written[0]
+    assert sorted(os.listdir(directory))[0] == os.path.basename(written[0])
+
+
+def test_pipeline():
+    from pterm.pipeline import (
+        Counter, collect, filter_stage, pipeline, tap_stage, transform_stage
+    )
+
+    aws_config = create_config('''
+        [profile 1]
+        [profile 2]
+        source_profile = 1
+    ''')
+    profiles = pterm.iter_aws_profiles(aws_config, azure_path)
+    assert not isinstance(profiles, list)
+
+    seen = []
+    counter = Counter()
+    names = collect(pipeline(
+        profiles,
+        tap_stage(lambda x: seen.append(x['Guid'])),
+        filter_stage(lambda x: not x['Name'].startswith('login-')),
+        counter,
+        transform_stage(lambda x: x['Name']),
+    ))
+    assert names == ['1', '2']
+    assert seen == ['1', '2', 'login-1']
+    assert counter.count == 2
+    assert [x['Name'] for x in create_aws_profiles(aws_config, azure_path)] == seen
+
+
+def test_scheduler():
+    from pterm.scheduler import Scheduler
+
+    def source(name, delay):
+        def run():
+            time.sleep(delay)
+            return [{'Name': f'{name}-{x}'} for x in range(2)]
+        return run
+
+    scheduler = Scheduler()
+    scheduler.add('slow', source('slow', 0.05))
+    scheduler.add('fast', source('fast', 0))
+    scheduler.add('after', lambda: [
+        {'Name': f"after-{x['Name']}"} for x in scheduler.result('slow')
+    ])
+
+    from pterm import instrument
+
+    instrument.enable()
+    try:
+        start = time.perf_counter()
+        names = [x['Name'] for x in scheduler.run()]
+        assert time.perf_counter() - start < 0.1
+        stats = instrument.stats()
+    finally:
+        instrument.disable()
+    assert stats['source slow']['time'] >= 0.05
+    assert sorted(stats) == ['source after', 'source fast', 'source slow']
+    assert names == [
+        'slow-0', 'slow-1', 'fast-0', 'fast-1', 'after-slow-0', 'after-slow-1',
+    ]
+
+    # the profiles of the current source are passed on while it runs
+    consumed = threading.Event()
+    streamed = []
+
+    def streaming():
+        yield {'Guid': 'first'}
+        streamed.append(consumed.wait(1))
+        yield {'Guid': 'second'}
+
+    for concurrent in (True, False):
+        consumed.clear()
+        scheduler = Scheduler(concurrent, keep={'other'})
+        scheduler.add('stream', streaming)
+        scheduler.add('other', lambda: [{'Guid': 'other'}])
+        for profile in scheduler.run():
+            if profile['Guid'] == 'first':
+                consumed.set()
+        assert scheduler.owners == {
+            'first': 'stream', 'second': 'stream', 'other': 'other',
+        }
+        assert scheduler.result('other') == [{'Guid': 'other'}]
+        with pytest.raises(ValueError):
+            scheduler.result('stream')
+    assert streamed == [True, True]
+
+    threads = []
+    scheduler = Scheduler(concurrent=False)
+    scheduler.add('main', lambda: threads.append(threading.current_thread()) or [{}])
+    scheduler.add('after', lambda: scheduler.result('main'))
+    assert list(scheduler.run()) == [{}, {}]
+    assert threads == [threading.main_thread()]
+
+
+@pytest.mark.parametrize('reset_peak', [True, False])
+def test_instrument(monkeypatch, reset_peak):
+    import tracemalloc
+    from pterm import instrument
+
+    if reset_peak and not hasattr(tracemalloc, 'reset_peak'):
+        pytest.skip('tracemalloc.reset_peak needs python 3.9')
+    monkeypatch.setattr(instrument, '_RESET_PEAK', reset_peak)
+
+    @instrument.instrumented('pytest call')
+    def call():
+        return 'called'
+
+    assert call() == 'called'
+    assert instrument.stats() == {}
+
+    instrument.enable(memory=True)
+    try:
+        for _ in range(3):
+            call()
+        with instrument.timed('pytest stage'):
+            [0] * 1000
+        with instrument.timed('pytest outer'):
+            with instrument.timed('pytest big'):
+                data = [0] * 1000000
+                del data
+            with instrument.timed('pytest small'):
+                [0] * 10
+        stats = instrument.stats()
+        summary = instrument.summary()
+    finally:
+        instrument.disable()
+
+    assert stats['pytest call']['calls'] == 3
+    assert stats['pytest stage']['calls'] == 1
+    assert stats['pytest stage']['peak'] > 0
+    assert stats['pytest big']['peak'] >= 8000000
+    assert stats['pytest outer']['peak'] >= stats['pytest big']['peak']
+    if reset_peak:
+        # the peaks are per stage, not since the tracing started
+        assert stats['pytest small']['peak'] < 100000
+    else:
+        assert stats['pytest small']['peak'] >= stats['pytest big']['peak']
+    assert summary[1].startswith('pytest call')
+    assert instrument.stats() == {}
+
+
+def test_login_profiles_unique():
+    calls = []
+
+    def counted_azure_path():
+        calls.append(1)
+        return azure_path()
+
+    config = '[profile azure]\nazure_tenant_id = foo\n[profile other]\n'
+    for index in range(500):
+        source = 'azure' if index % 2 else 'other'
+        config += f'[profile role-{index}]\nsource_profile = {source}\n'
+
+    aws_profiles = create_aws_profiles(create_config(config), counted_azure_path)
+    logins = [x['Name'] for x in aws_profiles if x['Name'].startswith('login-')]
+    assert logins == ['login-other', 'login-azure']
+    assert len(calls) == 1
+
+    kube = cluster_config('foo', aws_profile='role-1')
+    profiles = aws_profiles + [
+        create_k8s_profile(kube, '/dev/null', aws_profiles),
+        pterm.create_profile('pterm-default', change_title=True, badge=False),
+    ]
+    guids = [x['Guid'] for x in profiles]
+    assert len(guids) == len(set(guids))
+
+
+def test_smart_selection_rules(monkeypatch, capsys):
+    from pterm import rules
+
+    for rule in pterm.smart_selection_rules():
+        pattern, errors, warnings = rules.check_rule(rule, strict=True)
+        assert pattern is not None
+        assert errors == warnings == []
+
+    ssr = os.path.join(tempfile.mkdtemp(), 'ssr.json')
+    with open(ssr, 'w') as out:
+        json.dump([
+            {'notes': 'good', 'regex': r'foo-(\d+)', 'precision': 'high'},
+            {'notes': 'broken', 'regex': r'[\w-_]*'},
+            {'notes': 'slow', 'regex': r'(\w+\s?)+$'},
+            {'notes': 'icu', 'regex': r'\p{L}+'},
+            {'notes': 'named', 'regex': r'(?<name>x)\Qa.b\E\h+'},
+            {'notes': 'no regex'},
+            {'notes': 'precision', 'regex': 'x', 'precision': 'max'},
+        ], out)
+    monkeypatch.setattr(pterm, 'ssr_path', lambda: ssr)
+    rules.clear_cache()
+
+    notes = [x['notes'] for x in pterm.smart_selection_rules()]
+    assert notes[:5] == ['good', 'broken', 'slow', 'icu', 'named']
+    assert 'no regex' not in notes and 'precision' not in notes
+    err = capsys.readouterr().err
+    assert 'Warning, smart selection rule broken: regex not supported' in err
+    assert 'Warning, smart selection rule icu' in err
+    assert 'Warning, smart selection rule slow' in err
+    assert 'Error, smart selection rule no regex' in err
+    assert 'Error, smart selection rule precision' in err
+
+    assert pterm.compiled_smart_selection_rules() is \
+        pterm.compiled_smart_selection_rules()
+    assert capsys.readouterr().err == ''
+
+    with pytest.raises(ValueError):
+        rules.compile_rules([{'regex': '('}], strict=True)
+    rules.clear_cache()
+
+
+def test_watch():
+    from pterm import watch
+
+    directory = tempfile.mkdtemp()
+    config = os.path.join(directory, 'config')
+    missing = os.path.join(directory, 'missing')
+    with open(config, 'w') as out:
+        out.write('a')
+
+    watchers = [lambda: watch.PollingWatcher([config, missing], interval=0.01)]
+    probe = watch.watcher([config])
+    probe.close()
+    if isinstance(probe, watch.InotifyWatcher):
+        watchers += [lambda: watch.InotifyWatcher([config, missing])]
+
+    for create in watchers:
+        files = create()
+        assert files.wait(0.05) == set()
+        with open(os.path.join(directory, 'other'), 'w') as out:
+            out.write('b')
+        assert files.wait(0.05) == set()
+
+        with open(config + '.tmp', 'w') as out:
+            out.write(files.__class__.__name__)
+        os.replace(config + '.tmp', config)
+        assert files.wait(1) == {config}
+
+        with open(missing, 'w') as out:
+            out.write('c')
+        assert files.wait(1) == {missing}
+        os.remove(missing)
+        assert files.wait(1) == {missing}
+        files.close()
+
+    class Scripted:
+        def __init__(self, events):
+            self.events = events
+
+        def wait(self, timeout=None):
+            return self.events.pop(0)
+
+    bursts = watch.changes(Scripted([set(), {'a'}, {'b'}, set(), {'c'}, set()]))
+    assert next(bursts) == {'a', 'b'}
+    assert next(bursts) == {'c'}
+
+
+def test_iterm_client():
+    import asyncio
+    import websockets
+    from iterm2 import api_pb2
+    from iterm2._version import __version__
+    from pterm import iterm
+
+    profiles = {
+        'pterm-default': {'Guid': 'pterm-default', 'Name': 'pterm-default'},
+        '1': {'Guid': '1', 'Name': '1', 'Badge Text': '1', 'Tags': []},
+    }
+    connections = []
+    listed = []
+    defaults = []
+    held = []
+
+    async def respond(websocket, request, response):
+        response.id = request.id
+        await websocket.send(response.SerializeToString())
+
+    async def handler(websocket, path=None):
+        request = getattr(websocket, 'request', None)
+        headers = request.headers if request else websocket.request_headers
+        connections.append(headers.get('x-iterm2-library-version'))
+        async for data in websocket:
+            request = api_pb2.ClientOriginatedMessage()
+            request.ParseFromString(data)
+            response = api_pb2.ServerOriginatedMessage()
+            if request.HasField('list_profiles_request'):
+                keys = list(request.list_profiles_request.properties)
+                listed.append(keys)
+                for profile in profiles.values():
+                    this = response.list_profiles_response.profiles.add()
+                    for key in keys:
+                        prop = this.properties.add()
+                        prop.key = key
+                        prop.json_value = json.dumps(profile[key])
+                await respond(websocket, request, response)
+                continue
+
+            if request.HasField('preferences_request'):
+                defaults.append(request.preferences_request.requests[0]
+                                .set_default_profile_request.guid)
+                response.preferences_response.results.add() \
+                    .set_default_profile_result.SetInParent()
+            else:
+                this = request.set_profile_property_request
+                for assignment in this.assignments:
+                    profiles[this.guid_list.guids[0]][assignment.key] = \
+                        json.loads(assignment.json_value)
+                response.set_profile_property_response.status = \
+                    api_pb2.SetProfilePropertyResponse.OK
+            # answer the concurrent operations in reverse order
+            held.append((request, response))
+            if len(held) == 2:
+                for request, response in reversed(held):
+                    await respond(websocket, request, response)
+
+    async def session():
+        async with websockets.serve(handler, 'localhost', 0,
+                                    subprotocols=[iterm.SUBPROTOCOL]) as server:
+            port = list(server.sockets)[0].getsockname()[1]
+            async with await iterm.Client.connect(f'ws://localhost:{port}') as client:
+                updated = await iterm.sync(client, 'pterm-default', {
+                    '1': {'Badge Text': 'one', 'Tags': ['a']},
+                    'missing': {'Badge Text': 'x'},
+                })
+                return updated, client.requests
+
+    updated, requests = asyncio.run(session())
+    assert updated == ['1']
+    assert requests == 3
+    assert connections == [f'python {__version__}']
+    assert issubclass(websockets.exceptions.InvalidHandshake, iterm.errors())
+    assert issubclass(RuntimeError, iterm.errors())
+    assert listed == [['Guid', 'Name']]
+    assert defaults == ['pterm-default']
+    assert profiles['1'] == {'Guid': '1', 'Name': '1', 'Badge Text': 'one', 'Tags': ['a']}
+
+    old = [{'Guid': '1', 'Badge Text': '1', 'Tags': []}, {'Guid': '2'}]
+    new = [{'Guid': '1', 'Badge Text': '1', 'Tags': ['b'], 'Name': 'x'},
+           {'Guid': '2', 'Badge Text': '2'}, {'Guid': '3', 'Badge Text': '3'}]
+    assert iterm.live_updates(old, new) == {
+        '1': {'Tags': ['b']}, '2': {'Badge Text': '2'},
+    }
+
+
+def test_profile_model():
+    from pterm.profile import Profile, as_dict
+
+    profile = pterm.new_aws_profile('2-prod', source_profile='1', tags=['123'])
+    assert isinstance(profile, Profile)
+    assert as_dict(profile) == pterm.mkprofile('2-prod', source_profile='1', tags=['123'])
+    assert list(as_dict(profile)) == list(pterm.mkprofile('2-prod', source_profile='1'))
+    assert json.dumps(as_dict(profile)) == json.dumps(
+        pterm.mkprofile('2-prod', source_profile='1', tags=['123'])
+    )
+
+    template = pterm.profile_template()
+    other = pterm.new_profile('other')
+    assert other['Triggers'] is template['Triggers']
+    assert other['Keyboard Map'] is template['Keyboard Map']
+    assert profile['Keyboard Map'] is not template['Keyboard Map']
+    assert 'Command' not in other
+    assert len(other) == len(pterm.create_profile('other'))
+
+    other['Command'] = 'ls'
+    other['Custom Command'] = 'Yes'
+    other['Name'] = 'renamed'
+    assert list(other)[-2:] == ['Command', 'Custom Command']
+    assert (other['Name'], other['Guid']) == ('renamed', 'other')
+    assert other != pterm.new_profile('other')
+    del other['Badge Text']
+    with pytest.raises(KeyError):
+        other['Badge Text']  # pylint: disable=pointless-statement
+
+    copy = profile.copy()
+    copy['Tags'] = []
+    assert profile['Tags'] and copy != profile
+    assert as_dict({'Name': 'x'}) == {'Name': 'x'}
+    with pytest.raises(AttributeError):
+        profile.unknown = 1
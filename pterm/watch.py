@@ -0,0 +1,161 @@
+"""Watch the input files of pterm for changes.
+
+On Linux the directories of the files are watched with inotify, so editors
+that replace a file with a rename are noticed too. Elsewhere, or when
+inotify isnt available, the files are polled.
+"""
+
+import os
+import sys
+import time
+import select
+import struct
+import ctypes
+import ctypes.util
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+# struct inotify_event {int wd; uint32_t mask, cookie, len; char name[];}
+EVENT = struct.Struct('iIII')
+
+
+def _remaining(deadline):
+    """Return the seconds left until `deadline`, None for no deadline."""
+    if deadline is None:
+        return None
+    return max(deadline - time.monotonic(), 0)
+
+
+class PollingWatcher:
+    """Notice file changes by comparing their stat every `interval`."""
+
+    def __init__(self, paths, interval=1.0):
+        self.paths = [os.path.abspath(x) for x in paths]
+        self.interval = interval
+        self.states = {x: self._state(x) for x in self.paths}
+
+    @staticmethod
+    def _state(path):
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        return (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+
+    def wait(self, timeout=None):
+        """Return the paths that changed, or an empty set after `timeout`."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            changed = set()
+            for path in self.paths:
+                state = self._state(path)
+                if state != self.states[path]:
+                    self.states[path] = state
+                    changed.add(path)
+            remaining = _remaining(deadline)
+            if changed or remaining == 0:
+                return changed
+            time.sleep(self.interval if remaining is None else min(self.interval, remaining))
+
+    def close(self):
+        """Stop watching."""
+
+
+class InotifyWatcher:
+    """Notice file changes with inotify watches on their directories.
+
+    Symlinked files are also watched in the directory of their target.
+    Raises OSError if a directory cant be watched.
+    """
+
+    def __init__(self, paths):
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+
+        self.paths = [os.path.abspath(x) for x in paths]
+        self._dirs = {}
+        self._names = {}
+        try:
+            for path in self.paths:
+                for name in {path, os.path.realpath(path)}:
+                    directory, base = os.path.split(name)
+                    wd = libc.inotify_add_watch(
+                        self.fd, directory.encode(), IN_MASK
+                    )
+                    if wd < 0:
+                        error = ctypes.get_errno()
+                        raise OSError(error, os.strerror(error), directory)
+                    self._dirs[wd] = directory
+                    self._names[(directory, base)] = path
+        except OSError:
+            self.close()
+            raise
+
+    def _read(self):
+        """Return the watched paths of the pending events."""
+        changed = set()
+        try:
+            data = os.read(self.fd, 1 << 16)
+        except BlockingIOError:
+            return changed
+        offset = 0
+        while offset < len(data):
+            wd, _, _, length = EVENT.unpack_from(data, offset)
+            offset += EVENT.size
+            name = data[offset:offset + length].rstrip(b'\0').decode()
+            offset += length
+            path = self._names.get((self._dirs.get(wd), name))
+            if path is not None:
+                changed.add(path)
+        return changed
+
+    def wait(self, timeout=None):
+        """Return the paths that changed, or an empty set after `timeout`."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            ready, _, _ = select.select([self.fd], [], [], _remaining(deadline))
+            if not ready:
+                return set()
+            changed = self._read()
+            if changed:
+                return changed
+
+    def close(self):
+        """Stop watching."""
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+
+def watcher(paths, poll=False, interval=1.0):
+    """Return an inotify watcher on Linux and a polling one elsewhere."""
+    if not poll and sys.platform.startswith('linux'):
+        try:
+            return InotifyWatcher(paths)
+        except (OSError, AttributeError, TypeError):
+            pass
+    return PollingWatcher(paths, interval)
+
+
+def changes(watch, delay=0.2):
+    """Yield the set of paths changed by every burst of edits.
+
+    A burst ends once no file changed for `delay` seconds.
+    """
+    while True:
+        changed = watch.wait()
+        if not changed:
+            continue
+        while True:
+            more = watch.wait(delay)
+            if not more:
+                break
+            changed |= more
+        yield changed